@@ -16,18 +16,220 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
-
-
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
 
+from smssync.conf import get_setting
 from smssync.models import IncomingMessage, OutgoingMessage
+from smssync.notify import notify_outgoing
+from smssync.numbers import parse_number
+
+# query string parameter holding the cursor of KeysetChangeList
+CURSOR_VAR = 'after'
+
+
+def estimate_count(model, using):
+    """Approximate number of rows of the table of ``model``, read from the
+    database statistics, None if it doesn't keep any
+
+    SQLite only keeps statistics of the tables ANALYZE ran on.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class "
+                           "WHERE oid = to_regclass(%s)",
+                           [connection.ops.quote_name(table)])
+        elif connection.vendor == 'mysql':
+            cursor.execute("SELECT table_rows FROM information_schema.tables "
+                           "WHERE table_schema = DATABASE() "
+                           "AND table_name = %s", [table])
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master "
+                           "WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            # the first number of the stat column is the number of rows
+            cursor.execute("SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 "
+                           "WHERE tbl = %s", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for tables never analyzed
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator which never counts whole tables
+
+    Unfiltered tables are counted from the database statistics and
+    filtered querysets are only counted up to MAX_COUNT rows. Small tables
+    get exact counts.
+    """
+    MAX_COUNT = 10000
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        if not qs.query.where:
+            estimate = estimate_count(qs.model, qs.db)
+            if estimate is not None and estimate >= self.MAX_COUNT:
+                return estimate
+        return qs.order_by()[:self.MAX_COUNT].count()
+
+
+class KeysetChangeList(ChangeList):
+    """Change list reading only the displayed columns and paginated by a
+    cursor on (created, id) when sorted newest first, the default
+
+    Each page is a range scan of the (created, id) index starting after
+    the last row of the previous page, rather than an OFFSET reading and
+    skipping every row of the previous pages. Other orderings fall back to
+    numbered pages.
+    """
+    KEYSET_ORDERING = ('-created', '-pk')
+
+    def get_filters_params(self, params=None):
+        params = super(KeysetChangeList, self).get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def get_queryset(self, request, *args, **kwargs):
+        qs = super(KeysetChangeList, self).get_queryset(request, *args,
+                                                        **kwargs)
+        columns = []
+        for name in self.list_display:
+            try:
+                columns.append(self.lookup_opts.get_field(name).name)
+            except (FieldDoesNotExist, TypeError):
+                pass
+        return qs.only(*columns) if columns else qs
+
+    def get_cursor(self):
+        value = self.params.get(CURSOR_VAR)
+        if not value:
+            return None
+        created, _, pk = value.rpartition('_')
+        try:
+            created = parse_datetime(created)
+            pk = self.lookup_opts.pk.to_python(pk)
+        except (ValueError, ValidationError):
+            created = None
+        if created is None:
+            raise IncorrectLookupParameters("Invalid cursor")
+        return created, pk
 
+    def get_results(self, request):
+        self.next_url = self.first_url = None
+        if tuple(self.queryset.query.order_by) != self.KEYSET_ORDERING:
+            return super(KeysetChangeList, self).get_results(request)
 
-class IncomingMessageAdmin(admin.ModelAdmin):
+        qs = self.queryset
+        cursor = self.get_cursor()
+        if cursor:
+            created, pk = cursor
+            qs = (qs.filter(created__lte=created)
+                  .exclude(created=created, pk__gte=pk))
+            self.first_url = self.get_query_string(remove=[CURSOR_VAR])
+        rows = list(qs[:self.list_per_page + 1])
+        if len(rows) > self.list_per_page:
+            last = rows[self.list_per_page - 1]
+            self.next_url = self.get_query_string({
+                CURSOR_VAR: '{}_{}'.format(last.created.isoformat(),
+                                           last.pk)})
+
+        paginator = self.model_admin.get_paginator(request, self.queryset,
+                                                   self.list_per_page)
+        self.result_count = paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.result_list = rows[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = False
+        self.paginator = paginator
+
+
+class DeviceListFilter(admin.SimpleListFilter):
+    """The devices of SMSSYNC_DEVICES, rather than the distinct device_ids
+    of the whole table"""
+    title = "device"
+    parameter_name = 'device_id'
+
+    def lookups(self, request, model_admin):
+        return [(device, device) for device in get_setting('SMSSYNC_DEVICES')]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(device_id=self.value())
+        return queryset
+
+
+class MessageAdmin(admin.ModelAdmin):
+    """Admin of the message tables, whose change lists stay fast on
+    millions of rows: see EstimatedCountPaginator and KeysetChangeList"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # the number field matched exactly by searches
+    number_field = None
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search by phone number, an indexed equality rather than a LIKE
+        scan"""
+        search_term = search_term.strip()
+        if not search_term or not self.number_field:
+            return queryset, False
+        return queryset.filter(**{
+            self.number_field: parse_number(search_term)}), False
+
+
+class IncomingMessageAdmin(MessageAdmin):
     model = IncomingMessage
+    list_display = ('created', 'sent_from', 'message', 'device_id',
+                    'received')
+    list_filter = ('received', DeviceListFilter)
+    search_fields = ('sent_from',)
+    search_help_text = "Sender's phone number"
+    number_field = 'sent_from'
+
 
-class OutgoingMessageAdmin(admin.ModelAdmin):
+class OutgoingMessageAdmin(MessageAdmin):
     model = OutgoingMessage
+    list_display = ('created', 'to', 'message', 'device_id', 'status',
+                    'attempts')
+    list_filter = ('status', DeviceListFilter)
+    actions = ['requeue', 'expire', 'resend']
+
+    @admin.action(description="Queue the selected claimed messages again")
+    def requeue(self, request, queryset):
+        count = queryset.claimed().transition(OutgoingMessage.QUEUED,
+                                              claim_token=None)
+        notify_outgoing()
+        self.message_user(request, "Queued {} messages again".format(count))
+
+    @admin.action(description="Expire the selected messages")
+    def expire(self, request, queryset):
+        count = queryset.transition(OutgoingMessage.EXPIRED)
+        self.message_user(request, "Expired {} messages".format(count))
+
+    @admin.action(description="Send the selected failed or expired "
+                              "messages again")
+    def resend(self, request, queryset):
+        count = queryset.resend()
+        notify_outgoing()
+        self.message_user(request, "Queued {} messages again".format(count))
 
 admin.site.register(IncomingMessage, IncomingMessageAdmin)
 admin.site.register(OutgoingMessage, OutgoingMessageAdmin)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from smssync.conf import get_setting
+
+
+@lru_cache(maxsize=None)
+def _load_backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    """Return the message storage backend selected by SMSSYNC_BACKEND
+
+    The backend is instantiated once per process, so backends keeping
+    state in memory share it across requests.
+    """
+    return _load_backend(get_setting('SMSSYNC_BACKEND'))
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    if setting == 'SMSSYNC_BACKEND':
+        _load_backend.cache_clear()
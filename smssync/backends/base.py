@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from smssync.devices import get_router
+
+
+class BaseBackend(object):
+    """Storage for the outgoing and incoming message queues
+
+    Backends exchange messages as OutgoingMessage and IncomingMessage
+    instances, which are only saved to the database by backends storing
+    them there.
+    """
+
+    def send(self, text, to, device_id=None):
+        """Queue a message and return it
+
+        Without a ``device_id``, the message is routed by SMSSYNC_ROUTER.
+        """
+        raise NotImplementedError
+
+    def send_many(self, messages, batch_size=None, device_id=None):
+        """Queue (text, to) pairs and return the ids of the new messages"""
+        return [self.send(text, to, device_id).id for text, to in messages]
+
+    def route(self, messages):
+        """Assign the messages without a device to one, according to
+        SMSSYNC_ROUTER"""
+        router = get_router()
+        unrouted = [m for m in messages if not m.device_id]
+        if router is not None and unrouted:
+            router.route(unrouted, self)
+
+    def pending_counts(self, devices):
+        """Map each of ``devices`` to its number of queued messages"""
+        raise NotImplementedError
+
+    def queue_depths(self):
+        """Map each queue, "outgoing" and "incoming", to its number of
+        messages, for the queue depth gauges of smssync.metrics"""
+        return {}
+
+    def claim(self, limit=None, device_id=None):
+        """Take up to ``limit`` queued messages so that no other caller gets
+        them, and return them as send task dicts
+
+        Messages routed to ``device_id`` come first, then those not routed
+        to any device, oldest first.
+        """
+        raise NotImplementedError
+
+    def store(self, messages):
+        """Store incoming messages, ignoring those already stored, and
+        return the ones which were new"""
+        raise NotImplementedError
+
+    def receive(self, sent_from=None):
+        """Yield incoming messages, marking each as received beforehand"""
+        raise NotImplementedError
+
+    def receive_batches(self, batch_size=100, sent_from=None):
+        """Yield lists of incoming messages, marking each list as received
+        once the consumer moves past it"""
+        raise NotImplementedError
+
+    def mark_as_received(self, messages):
+        """Mark incoming messages, handled by other means than receive(),
+        as received"""
+        raise NotImplementedError
+
+    def archive(self, batch_size=1000):
+        """Copy the messages done with to the database, for backends that
+        keep them elsewhere, and return how many were copied"""
+        return 0
+
+    def retry(self, batch_size=1000):
+        """Queue again the claimed messages not acknowledged within
+        SMSSYNC_CLAIM_LEASE, expire those claimed SMSSYNC_MAX_ATTEMPTS times
+        and those older than SMSSYNC_MESSAGE_TTL. Returns the numbers of
+        messages queued and expired.
+
+        Only backends keeping track of claimed messages can do so.
+        """
+        return 0, 0
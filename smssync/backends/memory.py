@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict, defaultdict
+import threading
+
+from django.utils import timezone
+
+from smssync.backends.base import BaseBackend
+from smssync.models import OutgoingMessage
+from smssync.notify import notify_outgoing
+from smssync.numbers import parse_number
+
+
+class MemoryBackend(BaseBackend):
+    """Keep the message queues in the memory of the current process
+
+    Meant for tests and benchmarks: nothing is shared between processes
+    and everything is lost when the process exits. Messages that have been
+    sent or received are dropped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # one queue per device_id, "" for messages not routed to a device
+        self._outgoing = defaultdict(OrderedDict)
+        self._incoming = OrderedDict()
+        self._seen = set()
+
+    def send(self, text, to, device_id=None):
+        message = OutgoingMessage(to=parse_number(to), message=text,
+                                  device_id=device_id or "",
+                                  created=timezone.now())
+        self.route([message])
+        with self._lock:
+            self._outgoing[message.device_id][message.id] = message
+        notify_outgoing()
+        return message
+
+    def pending_counts(self, devices):
+        with self._lock:
+            return {device: len(self._outgoing.get(device, ()))
+                    for device in devices}
+
+    def queue_depths(self):
+        with self._lock:
+            return {'outgoing': sum(len(q) for q in self._outgoing.values()),
+                    'incoming': len(self._incoming)}
+
+    def claim(self, limit=None, device_id=None):
+        claimed = []
+        with self._lock:
+            for queue in ([device_id, ""] if device_id else [""]):
+                queue = self._outgoing.get(queue)
+                while queue and (limit is None or len(claimed) < limit):
+                    claimed.append(queue.popitem(last=False)[1])
+        now = timezone.now()
+        for message in claimed:
+            message.status = OutgoingMessage.CLAIMED
+            message.status_timestamp = now
+            message.claimed_timestamp = now
+        return [m.task_dict for m in claimed]
+
+    def store(self, messages):
+        now = timezone.now()
+        new = []
+        with self._lock:
+            for message in messages:
+                if message.id not in self._seen:
+                    self._seen.add(message.id)
+                    message.created = now
+                    self._incoming[message.id] = message
+                    new.append(message)
+        return new
+
+    def _take(self, count, sent_from):
+        with self._lock:
+            taken = []
+            for message in self._incoming.values():
+                if len(taken) == count:
+                    break
+                if not sent_from or message.sent_from == sent_from:
+                    taken.append(message)
+            return taken
+
+    def mark_as_received(self, messages):
+        now = timezone.now()
+        with self._lock:
+            for message in messages:
+                message.received = True
+                message.received_timestamp = now
+                self._incoming.pop(message.id, None)
+
+    def receive(self, sent_from=None):
+        while True:
+            taken = self._take(1, sent_from)
+            if not taken:
+                return
+            self.mark_as_received(taken)
+            yield taken[0]
+
+    def receive_batches(self, batch_size=100, sent_from=None):
+        while True:
+            batch = self._take(batch_size, sent_from)
+            if not batch:
+                return
+            yield batch
+            self.mark_as_received(batch)
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from smssync.backends.base import BaseBackend
+from smssync.conf import get_setting
+from smssync.models import IncomingMessage, OutgoingMessage
+from smssync.notify import notify_outgoing
+from smssync.numbers import parse_number
+
+
+class ORMBackend(BaseBackend):
+    """Keep every message in the database, through the Django ORM"""
+
+    def send(self, text, to, device_id=None):
+        message = OutgoingMessage(to=parse_number(to), message=text,
+                                  device_id=device_id or "")
+        self.route([message])
+        message.save()
+        notify_outgoing()
+        return message
+
+    def send_many(self, messages, batch_size=None, device_id=None):
+        """Numbers are parsed through the cache of smssync.numbers and the
+        messages are inserted with bulk_create, ``batch_size``
+        (SMSSYNC_SEND_MANY_BATCH_SIZE by default) at a time. Every batch is
+        committed on its own.
+        """
+        if batch_size is None:
+            batch_size = get_setting('SMSSYNC_SEND_MANY_BATCH_SIZE')
+        ids = []
+        batch = []
+        for text, to in messages:
+            batch.append(OutgoingMessage(to=parse_number(to), message=text,
+                                         device_id=device_id or ""))
+            if len(batch) == batch_size:
+                ids.extend(self._bulk_create(batch))
+                batch = []
+        if batch:
+            ids.extend(self._bulk_create(batch))
+        return ids
+
+    def _bulk_create(self, messages):
+        self.route(messages)
+        # ids are generated client side, no need to read them back
+        OutgoingMessage.objects.bulk_create(messages)
+        notify_outgoing()
+        return [m.id for m in messages]
+
+    def pending_counts(self, devices):
+        return OutgoingMessage.objects.pending_counts(devices)
+
+    def queue_depths(self):
+        """Both counts are read from the partial indexes on pending
+        messages"""
+        return {'outgoing': OutgoingMessage.objects.outgoing().count(),
+                'incoming': IncomingMessage.objects.incoming().count()}
+
+    def claim(self, limit=None, device_id=None):
+        claimed = OutgoingMessage.objects.claim(limit, device_id)
+        claimed = claimed.order_by('created')
+        return [OutgoingMessage.make_task_dict(*row)
+                for row in claimed.task_values()]
+
+    def retry(self, batch_size=1000):
+        """Messages are moved by conditional UPDATEs of up to
+        ``batch_size`` rows, found through partial indexes"""
+        queued = expired = 0
+        lease = get_setting('SMSSYNC_CLAIM_LEASE')
+        if lease is not None:
+            queued, expired = OutgoingMessage.objects.retry(
+                lease, get_setting('SMSSYNC_MAX_ATTEMPTS'), batch_size)
+        ttl = get_setting('SMSSYNC_MESSAGE_TTL')
+        if ttl is not None:
+            expired += OutgoingMessage.objects.expire(ttl, batch_size)
+        if queued:
+            notify_outgoing()
+        return queued, expired
+
+    def store(self, messages):
+        """Messages stored concurrently by another request may be
+        returned by both"""
+        stored = set(IncomingMessage.objects.filter(
+            id__in=[m.id for m in messages]).values_list('id', flat=True))
+        new = []
+        for message in messages:
+            if message.id not in stored:
+                stored.add(message.id)
+                new.append(message)
+        IncomingMessage.objects.bulk_create(new, ignore_conflicts=True)
+        return new
+
+    def _incoming(self, sent_from):
+        qs = IncomingMessage.objects.incoming()
+        if sent_from:
+            qs = qs.sent_from(sent_from)
+        return qs
+
+    def receive(self, sent_from=None):
+        for m in self._incoming(sent_from):
+            yield m.mark_as_received()
+
+    def receive_batches(self, batch_size=100, sent_from=None):
+        """Messages are streamed from the database ``batch_size`` at a
+        time and each batch is marked as received with a single UPDATE.
+        """
+        batch = []
+        for m in self._incoming(sent_from).iterator(chunk_size=batch_size):
+            batch.append(m)
+            if len(batch) == batch_size:
+                yield batch
+                self.mark_as_received(batch)
+                batch = []
+        if batch:
+            yield batch
+            self.mark_as_received(batch)
+
+    def mark_as_received(self, messages):
+        IncomingMessage.objects.filter(
+            id__in=[m.id for m in messages]).mark_as_received()
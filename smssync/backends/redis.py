@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from smssync.backends.base import BaseBackend
+from smssync.conf import get_setting
+from smssync.models import IncomingMessage, OutgoingMessage
+from smssync.notify import notify_outgoing
+from smssync.numbers import parse_number
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# moves up to ARGV[1] (all if 0) messages from the head of the queue to
+# the done list, each prefixed by the ARGV[2] timestamp, and returns them.
+# They are pushed 1000 at a time, unpack() being limited by the Lua stack.
+TAKE_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, ARGV[1] - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    local done = {}
+    for i, item in ipairs(items) do
+        done[i] = ARGV[2] .. ' ' .. item
+    end
+    for i = 1, #done, 1000 do
+        redis.call('RPUSH', KEYS[2], unpack(done, i, math.min(i + 999, #done)))
+    end
+end
+return items
+"""
+
+# queues the (id, message) pairs following ARGV[1] (key prefix) and ARGV[2]
+# (expiry) unless their id was seen before, returns the ids queued
+STORE_SCRIPT = """
+local stored = {}
+for i = 3, #ARGV, 2 do
+    if redis.call('SET', ARGV[1] .. ARGV[i], 1, 'NX', 'EX', ARGV[2]) then
+        redis.call('RPUSH', KEYS[1], ARGV[i + 1])
+        stored[#stored + 1] = ARGV[i]
+    end
+end
+return stored
+"""
+
+
+class RedisBackend(BaseBackend):
+    """Keep the message queues in Redis lists
+
+    Polls and posts from the devices never touch the database. Messages
+    that have been sent or received are moved to "done" lists, which
+    archive() copies to the OutgoingMessage and IncomingMessage tables; run
+    it periodically with the smssync_archive_backend management command.
+
+    Requires the redis package and Redis 2.6 or later.
+    """
+
+    def __init__(self):
+        if redis is None:
+            raise ImproperlyConfigured("RedisBackend requires the redis "
+                                       "package")
+        self.redis = redis.Redis.from_url(get_setting('SMSSYNC_REDIS_URL'))
+        prefix = get_setting('SMSSYNC_REDIS_PREFIX')
+        self.outgoing_key = prefix + ':outgoing'
+        self.sent_key = prefix + ':sent'
+        self.incoming_key = prefix + ':incoming'
+        self.received_key = prefix + ':received'
+        self.seen_prefix = prefix + ':seen:'
+        self._take = self.redis.register_script(TAKE_SCRIPT)
+        self._store = self.redis.register_script(STORE_SCRIPT)
+
+    def _queue_key(self, device_id):
+        """The list of messages routed to ``device_id``, or to no device"""
+        if device_id:
+            return self.outgoing_key + ':' + device_id
+        return self.outgoing_key
+
+    def _dump_outgoing(self, message):
+        return json.dumps({'id': str(message.id),
+                           'to': str(message.to),
+                           'message': message.message,
+                           'device_id': message.device_id,
+                           'created': message.created.isoformat()})
+
+    def _dump_incoming(self, message):
+        return json.dumps({'id': str(message.id),
+                           'from': str(message.sent_from),
+                           'message': message.message,
+                           'sent_to': message.sent_to,
+                           'device_id': message.device_id,
+                           'sent_timestamp': message.sent_timestamp.isoformat(),
+                           'created': message.created.isoformat()})
+
+    def _load_incoming(self, data):
+        return IncomingMessage(id=IncomingMessage._meta.pk.to_python(
+                                   data['id']),
+                               sent_from=parse_number(data['from']),
+                               message=data['message'],
+                               sent_to=data['sent_to'],
+                               device_id=data['device_id'],
+                               sent_timestamp=parse_datetime(
+                                   data['sent_timestamp']),
+                               created=parse_datetime(data['created']))
+
+    def send(self, text, to, device_id=None):
+        message = OutgoingMessage(to=parse_number(to), message=text,
+                                  device_id=device_id or "",
+                                  created=timezone.now())
+        self.route([message])
+        self.redis.rpush(self._queue_key(message.device_id),
+                         self._dump_outgoing(message))
+        notify_outgoing()
+        return message
+
+    def send_many(self, messages, batch_size=None, device_id=None):
+        if batch_size is None:
+            batch_size = get_setting('SMSSYNC_SEND_MANY_BATCH_SIZE')
+        ids = []
+        batch = []
+        now = timezone.now()
+        for text, to in messages:
+            batch.append(OutgoingMessage(to=parse_number(to), message=text,
+                                         device_id=device_id or "",
+                                         created=now))
+            if len(batch) == batch_size:
+                ids.extend(self._push(batch))
+                batch = []
+        if batch:
+            ids.extend(self._push(batch))
+        notify_outgoing()
+        return ids
+
+    def _push(self, messages):
+        self.route(messages)
+        queues = {}
+        for message in messages:
+            queues.setdefault(message.device_id, []).append(
+                self._dump_outgoing(message))
+        pipe = self.redis.pipeline()
+        for device_id, items in queues.items():
+            pipe.rpush(self._queue_key(device_id), *items)
+        pipe.execute()
+        return [m.id for m in messages]
+
+    def pending_counts(self, devices):
+        pipe = self.redis.pipeline()
+        for device in devices:
+            pipe.llen(self._queue_key(device))
+        return dict(zip(devices, pipe.execute()))
+
+    def queue_depths(self):
+        """The per device queues are found with SCAN"""
+        keys = [self.outgoing_key]
+        keys.extend(self.redis.scan_iter(match=self.outgoing_key + ':*'))
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.llen(key)
+        pipe.llen(self.incoming_key)
+        depths = pipe.execute()
+        return {'outgoing': sum(depths[:-1]), 'incoming': depths[-1]}
+
+    def claim(self, limit=None, device_id=None):
+        items = []
+        now = timezone.now().isoformat()
+        for device in ([device_id, ""] if device_id else [""]):
+            if limit is not None and len(items) >= limit:
+                break
+            count = limit - len(items) if limit is not None else 0
+            items.extend(self._take(keys=[self._queue_key(device),
+                                          self.sent_key],
+                                    args=[count, now]))
+        messages = [json.loads(item) for item in items]
+        return [OutgoingMessage.make_task_dict(m['id'], m['to'], m['message'])
+                for m in messages]
+
+    def store(self, messages):
+        if not messages:
+            return []
+        now = timezone.now()
+        args = [self.seen_prefix, get_setting('SMSSYNC_REDIS_SEEN_TIMEOUT')]
+        for message in messages:
+            message.created = now
+            args.extend([str(message.id), self._dump_incoming(message)])
+        stored = set(self._store(keys=[self.incoming_key], args=args))
+        new = []
+        for message in messages:
+            id = str(message.id).encode()
+            if id in stored:
+                stored.discard(id)
+                new.append(message)
+        return new
+
+    def _peek(self, count, sent_from):
+        """Return up to ``count`` incoming (raw item, message) pairs from
+        the head of the queue, without removing them
+
+        Filtering by sender scans the queue until enough messages are
+        found.
+        """
+        found = []
+        start = 0
+        while len(found) < count:
+            items = self.redis.lrange(self.incoming_key, start,
+                                      start + count - 1)
+            if not items:
+                break
+            for item in items:
+                message = self._load_incoming(json.loads(item))
+                if not sent_from or message.sent_from == sent_from:
+                    found.append((item, message))
+                    if len(found) == count:
+                        break
+            start += count
+        return found
+
+    def _mark_as_received(self, found):
+        now = timezone.now().isoformat()
+        pipe = self.redis.pipeline()
+        for item, message in found:
+            pipe.lrem(self.incoming_key, 1, item)
+            pipe.rpush(self.received_key, now + ' ' + item.decode())
+        pipe.execute()
+
+    def mark_as_received(self, messages):
+        """``messages`` must be the instances that were stored"""
+        self._mark_as_received([(self._dump_incoming(m).encode(), m)
+                                for m in messages])
+
+    def receive(self, sent_from=None):
+        while True:
+            found = self._peek(1, sent_from)
+            if not found:
+                return
+            self._mark_as_received(found)
+            yield found[0][1]
+
+    def receive_batches(self, batch_size=100, sent_from=None):
+        """Concurrent consumers may get the same messages"""
+        while True:
+            found = self._peek(batch_size, sent_from)
+            if not found:
+                return
+            yield [message for item, message in found]
+            self._mark_as_received(found)
+
+    def _archive(self, key, model, make, batch_size):
+        archived = 0
+        while True:
+            pipe = self.redis.pipeline()
+            pipe.lrange(key, 0, batch_size - 1)
+            pipe.ltrim(key, batch_size, -1)
+            items = pipe.execute()[0]
+            if not items:
+                return archived
+            try:
+                messages = []
+                for item in items:
+                    timestamp, data = item.decode().split(' ', 1)
+                    messages.append(make(parse_datetime(timestamp),
+                                         json.loads(data)))
+                model.objects.bulk_create(messages, ignore_conflicts=True)
+            except Exception:
+                # put them back for the next run
+                self.redis.lpush(key, *reversed(items))
+                raise
+            archived += len(items)
+
+    def _make_outgoing(self, timestamp, data):
+        return OutgoingMessage(id=data['id'],
+                               to=data['to'],
+                               message=data['message'],
+                               device_id=data.get('device_id', ""),
+                               status=OutgoingMessage.SENT,
+                               status_timestamp=timestamp,
+                               claimed_timestamp=timestamp,
+                               sent_timestamp=timestamp)
+
+    def _make_incoming(self, timestamp, data):
+        message = self._load_incoming(data)
+        message.received = True
+        message.received_timestamp = timestamp
+        return message
+
+    def archive(self, batch_size=1000):
+        """The created timestamp of archived messages is the time of the
+        archival; outgoing messages handed to a device are archived as sent,
+        so that the queue never claims them again"""
+        return (self._archive(self.sent_key, OutgoingMessage,
+                              self._make_outgoing, batch_size) +
+                self._archive(self.received_key, IncomingMessage,
+                              self._make_incoming, batch_size))
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # dotted path of the class storing the message queues
+    'SMSSYNC_BACKEND': 'smssync.backends.orm.ORMBackend',
+    # RedisBackend connection and key prefix
+    'SMSSYNC_REDIS_URL': 'redis://localhost:6379/0',
+    'SMSSYNC_REDIS_PREFIX': 'smssync',
+    # seconds RedisBackend remembers incoming message ids, to ignore posts
+    # of messages already received
+    'SMSSYNC_REDIS_SEEN_TIMEOUT': 7 * 24 * 3600,
+    # maximum number of messages handed to a device on each send task
+    'SMSSYNC_SEND_BATCH_SIZE': 100,
+    # per device overrides of SMSSYNC_SEND_BATCH_SIZE, keyed by device_id
+    'SMSSYNC_DEVICE_SEND_BATCH_SIZE': {},
+    # maximum number of message results asked for on each result task
+    'SMSSYNC_RESULT_BATCH_SIZE': 100,
+    # number of messages inserted per query by smssync.send_many()
+    'SMSSYNC_SEND_MANY_BATCH_SIZE': 500,
+    # size of the thread pool running the database work of AsyncSyncView
+    'SMSSYNC_ASYNC_DB_THREADS': 10,
+    # maximum number of messages handed to each device per minute and per
+    # hour, None for no limit
+    'SMSSYNC_RATE_LIMIT_PER_MINUTE': None,
+    'SMSSYNC_RATE_LIMIT_PER_HOUR': None,
+    # cache holding the rate limits state
+    'SMSSYNC_RATE_LIMIT_CACHE': 'default',
+    # secret expected from the devices
+    'SMSSYNC_SECRET_KEY': None,
+    # per device overrides of SMSSYNC_SECRET_KEY, keyed by device_id
+    'SMSSYNC_DEVICE_SECRETS': {},
+    # accept devices which don't send a secret when none of the above is
+    # set, rather than refusing to serve them
+    'SMSSYNC_ALLOW_NO_SECRET': False,
+    # dotted path of the class assigning outgoing messages to devices, None
+    # to let any device send any message
+    'SMSSYNC_ROUTER': None,
+    # device_ids of the devices messages are routed to
+    'SMSSYNC_DEVICES': [],
+    # seconds a send task poll may wait for new messages, 0 to answer at
+    # once
+    'SMSSYNC_LONG_POLL_TIMEOUT': 0,
+    # number of threads running the receive handlers, and of messages
+    # waiting for them beyond which new ones are left to receive()
+    'SMSSYNC_HANDLER_THREADS': 4,
+    'SMSSYNC_HANDLER_QUEUE_SIZE': 1000,
+    # number of distinct phone numbers whose parsed and formatted forms are
+    # cached by smssync.numbers
+    'SMSSYNC_NUMBER_CACHE_SIZE': 10000,
+    # hand the numbers to the devices in E.164 rather than in
+    # PHONENUMBER_DEFAULT_FORMAT
+    'SMSSYNC_E164_NUMBERS': False,
+    # seconds a device has to acknowledge a claimed message before it is
+    # queued again, doubled on each attempt, None to never queue it again
+    'SMSSYNC_CLAIM_LEASE': None,
+    # number of claims after which an unacknowledged message expires
+    'SMSSYNC_MAX_ATTEMPTS': 5,
+    # seconds after which a message not sent yet expires, None for never
+    'SMSSYNC_MESSAGE_TTL': None,
+    # dotted path of the smssync.metrics.Metrics class receiving the
+    # measurements, None to take none
+    'SMSSYNC_METRICS': None,
+    # fraction of the messages going through the sync views which are
+    # logged, and fields masked in the logs
+    'SMSSYNC_LOG_SAMPLE_RATE': 1.0,
+    'SMSSYNC_LOG_REDACTED_FIELDS': ('secret',),
+    # StatsdMetrics daemon address and name prefix
+    'SMSSYNC_STATSD_ADDRESS': ('localhost', 8125),
+    'SMSSYNC_STATSD_PREFIX': 'smssync',
+}
+
+
+def get_setting(name):
+    """Return the project's value for an smssync setting or its default"""
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def get_send_batch_size(device_id=None):
+    """Return how many messages a device may claim on a single poll"""
+    per_device = get_setting('SMSSYNC_DEVICE_SEND_BATCH_SIZE')
+    if device_id in per_device:
+        return per_device[device_id]
+    return get_setting('SMSSYNC_SEND_BATCH_SIZE')
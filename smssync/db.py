@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import threading
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+from smssync.conf import get_setting
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool running smssync's database work for async
+    views, creating it on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_setting('SMSSYNC_ASYNC_DB_THREADS'),
+                    thread_name_prefix='smssync-db')
+    return _executor
+
+
+def database_sync_to_async(func):
+    """Turn a function using the ORM into a coroutine function
+
+    Unlike a plain sync_to_async, calls are not funnelled through the
+    single thread-sensitive thread shared with every other sync part of
+    the project, but run in a dedicated pool of SMSSYNC_ASYNC_DB_THREADS
+    threads. Each thread holds its own connection, which is checked before
+    and after every call like Django does around requests.
+    """
+    @wraps(func)
+    def _run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(_run, thread_sensitive=False,
+                         executor=get_executor())
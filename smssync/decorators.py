@@ -17,39 +17,124 @@
 # You should have received a copy of the GNU General Public License
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
 
+from functools import wraps
+import hmac
+from urllib.parse import unquote_to_bytes
+
 from django.http import JsonResponse
-from django.conf import settings
+
+from smssync.devices import get_device_secrets
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+MULTIPART_CONTENT_TYPE = 'multipart/form-data'
+
+
+def get_form_fields(body, names, encoding=None):
+    """Pick the ``names`` fields out of an urlencoded body, without
+    decoding the others
+
+    Like QueryDict.get(), the last occurrence of a field wins.
+    """
+    prefixes = [(name, name.encode() + b'=') for name in names]
+    fields = {}
+    for pair in body.split(b'&'):
+        for name, prefix in prefixes:
+            if pair.startswith(prefix):
+                value = unquote_to_bytes(pair[len(prefix):].replace(b'+',
+                                                                    b' '))
+                fields[name] = value.decode(encoding or 'utf-8', 'replace')
+    return fields
+
+
+def get_request_credentials(request):
+    """Return the secret and the device_id sent with the request
+
+    Both come from the same place: the body of form posts, as SMSSync
+    sends them, the query string otherwise, which is where batch and
+    results posts carry them. Urlencoded bodies only have these two fields
+    picked out, so that rejecting a request never costs a full form parse.
+    """
+    if request.method == 'POST':
+        if request.content_type == FORM_CONTENT_TYPE:
+            fields = get_form_fields(request.body, ('secret', 'device_id'),
+                                     request.encoding)
+            return fields.get('secret'), fields.get('device_id')
+        if request.content_type == MULTIPART_CONTENT_TYPE:
+            return request.POST.get('secret'), request.POST.get('device_id')
+    return request.GET.get('secret'), request.GET.get('device_id')
+
+
+def get_request_secret(request):
+    return get_request_credentials(request)[0]
+
+
+def get_request_device_id(request):
+    """The device_id the request was checked for by check_request_secret(),
+    which the views record rather than reading it again"""
+    try:
+        return request.smssync_device_id
+    except AttributeError:
+        return get_request_credentials(request)[1]
+
+
+def check_request_secret(request, secret_key=None):
+    """Whether the request carries the secret of the device sending it, or
+    ``secret_key`` if given
+
+    The device_id is kept as ``request.smssync_device_id``.
+    """
+    secret, device_id = get_request_credentials(request)
+    request.smssync_device_id = device_id
+    if secret_key is not None:
+        return (secret is not None and
+                hmac.compare_digest(secret.encode(), secret_key.encode()))
+    return get_device_secrets().check(secret, device_id)
+
+
+def secret_mismatch_response():
+    payload={}
+    payload['success'] = False
+    reason_phrase = ("The secret value sent from the device does "
+                     "not match the one on the server")
+    payload['error'] = reason_phrase
+
+    return JsonResponse({'payload':payload}, status=403)
+
 
 def secret_required(function=None, secret_key=None):
     """Check that the secret sent by the device mathces the configuration
 
     This decorator ensures that the 'secret' field in the requests matches
-    the secret configured on the server
+    the secret configured on the server for the device (see
+    smssync.devices.DeviceSecrets), or ``secret_key`` if given. The
+    settings are read when requests come in, not when the decorator is
+    applied.
     """
-    if secret_key is None:
-        secret_key = settings.SMSSYNC_SECRET_KEY
-
     def _dec(view_func):
+        @wraps(view_func)
         def _view(request, *args, **kwargs):
-            request_secret = ''
-            if request.method == 'GET':
-                request_secret = request.GET.get('secret')
-            elif request.method == 'POST':
-                request_secret = request.POST.get('secret')
-            if request_secret == secret_key:
+            if check_request_secret(request, secret_key):
                 return view_func(request, *args, **kwargs)
             else:
-                payload={}
-                payload['success'] = False
-                reason_phrase = ("The secret value sent from the device does "
-                                 "not match the one on the server")
-                payload['error'] = reason_phrase
+                return secret_mismatch_response()
+
+        return _view
+
+    if function is None:
+        return _dec
+    else:
+        return _dec(function)
 
-                return JsonResponse({'payload':payload}, status=403)
 
-        _view.__name__ = view_func.__name__
-        _view.__dict__ = view_func.__dict__
-        _view.__doc__ = view_func.__doc__
+def async_secret_required(function=None, secret_key=None):
+    """Async version of secret_required, for views running under ASGI"""
+    def _dec(view_func):
+        @wraps(view_func)
+        async def _view(request, *args, **kwargs):
+            if check_request_secret(request, secret_key):
+                return await view_func(request, *args, **kwargs)
+            else:
+                return secret_mismatch_response()
 
         return _view
 
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect
+from functools import lru_cache
+import hashlib
+import heapq
+import hmac
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from smssync.conf import get_setting
+
+
+class Router(object):
+    """Assign outgoing messages to the devices which should send them"""
+
+    def __init__(self, devices):
+        self.devices = list(devices)
+
+    def route(self, messages, backend):
+        """Set the device_id of ``messages``, about to be queued in
+        ``backend``"""
+        raise NotImplementedError
+
+
+class HashRouter(Router):
+    """Send all messages to a number from the same device
+
+    Numbers are spread over the devices by consistent hashing, so adding
+    or removing a device only moves the numbers of about one device.
+    """
+    REPLICAS = 100
+
+    def __init__(self, devices):
+        super(HashRouter, self).__init__(devices)
+        ring = sorted((self._hash("{}#{}".format(device, i)), device)
+                      for device in self.devices
+                      for i in range(self.REPLICAS))
+        self._keys = [key for key, device in ring]
+        self._ring = [device for key, device in ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def device_for(self, number):
+        i = bisect(self._keys, self._hash(str(number))) % len(self._keys)
+        return self._ring[i]
+
+    def route(self, messages, backend):
+        for message in messages:
+            message.device_id = self.device_for(message.to)
+
+
+class LeastLoadedRouter(Router):
+    """Send each message from the device with the fewest pending messages"""
+
+    def route(self, messages, backend):
+        counts = backend.pending_counts(self.devices)
+        heap = [(counts[device], device) for device in self.devices]
+        heapq.heapify(heap)
+        for message in messages:
+            count, device = heapq.heappop(heap)
+            message.device_id = device
+            heapq.heappush(heap, (count + 1, device))
+
+
+@lru_cache(maxsize=None)
+def _load_router(path, devices):
+    if not path or not devices:
+        return None
+    return import_string(path)(devices)
+
+
+def get_router():
+    """Return the router selected by SMSSYNC_ROUTER for SMSSYNC_DEVICES, or
+    None if messages are not routed"""
+    return _load_router(get_setting('SMSSYNC_ROUTER'),
+                        tuple(get_setting('SMSSYNC_DEVICES')))
+
+
+class DeviceSecrets(object):
+    """The secrets expected from the devices: their own one from
+    SMSSYNC_DEVICE_SECRETS, SMSSYNC_SECRET_KEY otherwise
+
+    When only per device secrets are configured, devices without one are
+    rejected.
+    """
+
+    def __init__(self, default, secrets):
+        self.default = default
+        self.secrets = dict(secrets)
+        self._encoded = {device_id: secret.encode()
+                         for device_id, secret in self.secrets.items()}
+        if default is not None:
+            self._encoded_default = default.encode()
+
+    def get(self, device_id=None):
+        return self.secrets.get(device_id, self.default)
+
+    def check(self, secret, device_id=None):
+        """Whether ``secret`` is the one of ``device_id``, in a time which
+        doesn't depend on how much of it is right"""
+        expected = self._encoded.get(device_id)
+        if expected is None:
+            if self.default is None:
+                # no secret configured at all, the device must not send one
+                return not secret and not self.secrets
+            expected = self._encoded_default
+        if secret is None:
+            return False
+        return hmac.compare_digest(secret.encode(), expected)
+
+
+@lru_cache(maxsize=None)
+def get_device_secrets():
+    """Return the secrets of the devices, read from the settings once
+
+    Raises ImproperlyConfigured when no secret is set, unless
+    SMSSYNC_ALLOW_NO_SECRET says the devices don't send any.
+    """
+    default = get_setting('SMSSYNC_SECRET_KEY')
+    secrets = get_setting('SMSSYNC_DEVICE_SECRETS')
+    if default is None and not secrets and \
+            not get_setting('SMSSYNC_ALLOW_NO_SECRET'):
+        raise ImproperlyConfigured("Set SMSSYNC_SECRET_KEY or "
+                                   "SMSSYNC_DEVICE_SECRETS, or "
+                                   "SMSSYNC_ALLOW_NO_SECRET to accept "
+                                   "devices without a secret")
+    return DeviceSecrets(default, secrets)
+
+
+@receiver(setting_changed)
+def _reset_device_secrets(setting, **kwargs):
+    if setting in ('SMSSYNC_SECRET_KEY', 'SMSSYNC_DEVICE_SECRETS',
+                   'SMSSYNC_ALLOW_NO_SECRET'):
+        get_device_secrets.cache_clear()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import queue
+import re
+import threading
+
+from django.db import close_old_connections, transaction
+from phonenumber_field.phonenumber import to_python
+
+from smssync.backends import get_backend
+from smssync.conf import get_setting
+from smssync.logs import MessageIds
+
+logger = logging.getLogger(__name__)
+
+
+class Handler(object):
+    """A function called with the incoming messages matching all of the
+    given ``sent_from`` number, case insensitive keyword ``prefix`` and
+    ``regex`` (matched at the start of the message)"""
+
+    def __init__(self, func, sent_from=None, prefix=None, regex=None):
+        self.func = func
+        self.sent_from = to_python(sent_from) if sent_from else None
+        self.prefix = prefix.lower() if prefix else None
+        self.regex = re.compile(regex) if regex else None
+
+    def matches(self, message):
+        if self.sent_from is not None and message.sent_from != self.sent_from:
+            return False
+        if (self.prefix is not None and
+                not message.message.lstrip().lower().startswith(self.prefix)):
+            return False
+        if self.regex is not None and not self.regex.match(message.message):
+            return False
+        return True
+
+    def handle(self, message):
+        """Call the function if ``message`` matches, returns whether it
+        did"""
+        if not self.matches(message):
+            return False
+        self.func(message)
+        return True
+
+
+class Dispatcher(object):
+    """Run the handlers of incoming messages in a pool of worker threads
+
+    Devices get their response without waiting for the handlers: messages
+    are put in a bounded queue (SMSSYNC_HANDLER_QUEUE_SIZE) drained by
+    SMSSYNC_HANDLER_THREADS threads, started on first use. When the queue
+    is full, new messages are not dispatched, now or later: their ids are
+    logged and they stay in the receive queue of the backend, for
+    smssync.receive() and friends.
+
+    Handlers are objects with a handle(message) method returning whether
+    they handled the message, like Handler and KeywordRouter. Messages are
+    marked as received once handled without error by any handler. Only new
+    messages are dispatched, not those a device posts again.
+    """
+    batch_size = 100
+
+    def __init__(self):
+        self.handlers = []
+        self._lock = threading.Lock()
+        self._queue = None
+
+    def register(self, handler):
+        with self._lock:
+            self.handlers = self.handlers + [handler]
+
+    def unregister(self, handler):
+        """Remove ``handler``, or the Handler calling it"""
+        with self._lock:
+            self.handlers = [h for h in self.handlers if h is not handler and
+                             getattr(h, 'func', None) is not handler]
+
+    def _get_queue(self):
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = queue.Queue(
+                        get_setting('SMSSYNC_HANDLER_QUEUE_SIZE'))
+                    for i in range(get_setting('SMSSYNC_HANDLER_THREADS')):
+                        threading.Thread(target=self._work,
+                                         name='smssync-handler-{}'.format(i),
+                                         daemon=True).start()
+        return self._queue
+
+    def dispatch(self, messages):
+        """Hand ``messages`` to the worker threads without waiting and
+        return how many were accepted"""
+        if not self.handlers:
+            return 0
+        jobs = self._get_queue()
+        accepted = 0
+        for message in messages:
+            try:
+                jobs.put_nowait(message)
+            except queue.Full:
+                # they are not dispatched again, receive() reads them
+                logger.warning("Handler queue full, %d messages left to "
+                               "receive(): %s", len(messages) - accepted,
+                               MessageIds(messages[accepted:]))
+                break
+            accepted += 1
+        return accepted
+
+    def join(self):
+        """Block until every dispatched message was handled"""
+        if self._queue is not None:
+            self._queue.join()
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            # take what else is waiting, to mark it received at once
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            try:
+                self.handle(batch)
+            except Exception:
+                logger.exception("Error marking messages as received")
+            finally:
+                close_old_connections()
+                for message in batch:
+                    self._queue.task_done()
+
+    def handle(self, messages):
+        """Run the handlers of each message and mark those which were
+        handled as received
+
+        Every handler sees the message even if another one fails, but the
+        message is only marked as received if none of them failed.
+        """
+        handled = []
+        for message in messages:
+            matched = failed = False
+            for handler in self.handlers:
+                try:
+                    matched = handler.handle(message) or matched
+                except Exception:
+                    logger.exception("Error handling message {} with {!r}"
+                                     .format(message.id, handler))
+                    failed = True
+            if matched and not failed:
+                handled.append(message)
+        if handled:
+            get_backend().mark_as_received(handled)
+
+
+# handlers registered with smssync.register_receive_handler()
+receive_handlers = Dispatcher()
+
+
+def dispatch_received(messages, using=None):
+    """Hand messages just stored to their handlers once the current
+    transaction commits"""
+    if receive_handlers.handlers:
+        transaction.on_commit(lambda: receive_handlers.dispatch(messages),
+                              using=using)
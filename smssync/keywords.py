@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+class Route(object):
+    """A keyword and the function its messages are handed to"""
+
+    def __init__(self, keyword, func):
+        self.keyword = keyword
+        self.func = func
+        self.hits = 0
+
+
+class KeywordRouter(object):
+    """Hand incoming messages to the function registered for their leading
+    keyword, e.g. "STOP" or "JOIN <group>"
+
+    Keywords are one or more words, matched case insensitively and
+    regardless of the whitespace between them. They are compiled into a
+    trie of words, so finding the route of a message only looks at the
+    words of its keyword, however many routes there are. When keywords
+    overlap, the longest wins ("JOIN VIP" over "JOIN").
+
+    Route functions are called with the message and the rest of its text
+    after the keyword. Register the router with
+    smssync.register_receive_handler() to route incoming messages; messages
+    without a known keyword go to ``default`` if given, and are left
+    unhandled otherwise.
+    """
+
+    def __init__(self, default=None):
+        self.default = default
+        self.misses = 0
+        self._routes = {}
+        self._trie = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(keyword):
+        return tuple(word.casefold() for word in keyword.split())
+
+    def add(self, keyword, func):
+        words = self.normalize(keyword)
+        if not words:
+            raise ValueError("Empty keyword")
+        with self._lock:
+            if words in self._routes:
+                raise ValueError("Keyword {} is already routed"
+                                 .format(keyword))
+            route = self._routes[words] = Route(" ".join(keyword.split()),
+                                                func)
+            node = self._trie
+            for word in words:
+                node = node.setdefault(word, {})
+            # None can't be a word, it marks the end of a keyword
+            node[None] = route
+        return route
+
+    def route(self, keyword):
+        """Decorator routing ``keyword`` to the function it decorates"""
+        def register(func):
+            self.add(keyword, func)
+            return func
+        return register
+
+    def resolve(self, text):
+        """Return the route of ``text`` and the rest of the text after its
+        keyword, (None, text) if no keyword matches"""
+        words = text.split()
+        node = self._trie
+        found = None
+        for i, word in enumerate(words):
+            node = node.get(word.casefold())
+            if node is None:
+                break
+            if None in node:
+                found = node[None], i + 1
+        if found is None:
+            return None, text
+        route, length = found
+        return route, " ".join(words[length:])
+
+    def handle(self, message):
+        route, rest = self.resolve(message.message)
+        with self._lock:
+            if route is None:
+                self.misses += 1
+            else:
+                route.hits += 1
+        if route is not None:
+            route.func(message, rest)
+        elif self.default is not None:
+            self.default(message, rest)
+        else:
+            return False
+        return True
+
+    def hits(self):
+        """Map each keyword to the number of messages routed to it"""
+        with self._lock:
+            return {route.keyword: route.hits
+                    for route in self._routes.values()}
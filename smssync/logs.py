@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import random
+
+from smssync.conf import get_setting
+
+REDACTED = '********'
+
+
+class Redacted(object):
+    """A dict of message fields, whose repr masks the ``redacted`` ones
+
+    Nothing is copied or formatted until a handler formats the record.
+    """
+    __slots__ = ('fields', 'redacted')
+
+    def __init__(self, fields, redacted):
+        self.fields = fields
+        self.redacted = redacted
+
+    def as_dict(self):
+        if self.redacted.isdisjoint(self.fields):
+            return self.fields
+        return {k: REDACTED if k in self.redacted else v
+                for k, v in self.fields.items()}
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    __str__ = __repr__
+
+
+class MessageIds(object):
+    """The ids of ``messages``, only joined when a handler formats the
+    record"""
+    __slots__ = ('messages',)
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __str__(self):
+        return ", ".join(str(m.id) for m in self.messages)
+
+
+class MessageLogger(object):
+    """Log one record per message going through the sync views
+
+    Records are only built when the logger is enabled for ``level``,
+    checked once per batch of messages, and for a random fraction
+    SMSSYNC_LOG_SAMPLE_RATE of the messages. The fields of each message are
+    the argument of the record, a Redacted instance masking
+    SMSSYNC_LOG_REDACTED_FIELDS, which structured formatters can turn into
+    a dict.
+    """
+
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+
+    def log(self, msg, messages):
+        """Log ``msg`` with each of the ``messages`` field dicts"""
+        if not self.logger.isEnabledFor(self.level):
+            return
+        rate = get_setting('SMSSYNC_LOG_SAMPLE_RATE')
+        redacted = frozenset(get_setting('SMSSYNC_LOG_REDACTED_FIELDS'))
+        for fields in messages:
+            if rate >= 1 or random.random() < rate:
+                self.logger.log(self.level, msg, Redacted(fields, redacted))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from smssync.models import (ArchivedIncomingMessage, ArchivedOutgoingMessage,
+                            IncomingMessage, OutgoingMessage)
+
+
+class Command(BaseCommand):
+    help = ("Move the messages handed to a device and received more than "
+            "DAYS days ago to the archive tables, or delete them")
+
+    def add_arguments(self, parser):
+        parser.add_argument('days', type=float,
+                            help="Age in days of the messages to archive")
+        parser.add_argument('--purge', action='store_true',
+                            help="Delete the messages rather than archiving "
+                                 "them")
+        parser.add_argument('--purge-archive', type=float, metavar='DAYS',
+                            help="Also delete the archived messages older "
+                                 "than DAYS days")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of messages moved per transaction")
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running, archiving every INTERVAL "
+                                 "seconds")
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError("DAYS must not be negative")
+        batch_size = options['batch_size']
+        while True:
+            cutoff = self.cutoff(options['days'])
+            done = [
+                (OutgoingMessage.objects.archivable().filter(
+                    created__lt=cutoff),
+                 ArchivedOutgoingMessage),
+                (IncomingMessage.objects.received().filter(
+                    created__lt=cutoff),
+                 ArchivedIncomingMessage),
+            ]
+            for qs, archive in done:
+                if options['purge']:
+                    count = qs.purge(batch_size)
+                    self.stdout.write("Deleted {} {}".format(
+                        count, qs.model._meta.verbose_name_plural))
+                else:
+                    count = qs.move_to(archive, batch_size)
+                    self.stdout.write("Archived {} {}".format(
+                        count, qs.model._meta.verbose_name_plural))
+
+            if options['purge_archive'] is not None:
+                cutoff = self.cutoff(options['purge_archive'])
+                for archive in (ArchivedOutgoingMessage,
+                                ArchivedIncomingMessage):
+                    count = archive.objects.filter(
+                        created__lt=cutoff).purge(batch_size)
+                    self.stdout.write("Deleted {} {}".format(
+                        count, archive._meta.verbose_name_plural))
+
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
+
+    def cutoff(self, days):
+        return timezone.now() - datetime.timedelta(days=days)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from smssync.metrics import collect_gauges, get_metrics
+
+
+class Command(BaseCommand):
+    help = ("Send the queue depths and phone number cache gauges to "
+            "SMSSYNC_METRICS, for exporters which push them like "
+            "StatsdMetrics")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running, sending them every INTERVAL "
+                                 "seconds")
+
+    def handle(self, *args, **options):
+        metrics = get_metrics()
+        if metrics is None:
+            raise CommandError("SMSSYNC_METRICS is not set")
+        while True:
+            collect_gauges(metrics)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from smssync.backends import get_backend
+
+
+class Command(BaseCommand):
+    help = ("Queue again the messages devices didn't acknowledge in time "
+            "and expire stale ones")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Number of messages updated per query")
+        parser.add_argument('--interval', type=float, default=0,
+                            help="Keep running, checking every INTERVAL "
+                                 "seconds")
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        while True:
+            queued, expired = backend.retry(options['batch_size'])
+            self.stdout.write("Queued {} messages again, expired {}"
+                              .format(queued, expired))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
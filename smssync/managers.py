@@ -18,17 +18,362 @@
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.db import models
+import datetime
+import uuid
 
+from django.db import connections, models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
-class OutgoingMessageQuerySet(models.QuerySet):
+
+def status_in(*statuses):
+    """Filter on any of ``statuses``
+
+    The statuses are ORed equalities rather than an IN lookup, whose values
+    SQLite doesn't look at when matching the query against the condition
+    of a partial index. Partial indexes on statuses use the same filter, in
+    the same order.
+    """
+    q = models.Q()
+    for status in statuses:
+        q |= models.Q(status=status)
+    return q
+
+
+def report_order():
+    """When the results of a message were last asked for, or when it was
+    claimed if they never were"""
+    return Coalesce('report_requested_timestamp', 'claimed_timestamp')
+
+
+class RetentionQuerySet(models.QuerySet):
+    """Moves messages to the archive tables and deletes them in batches,
+    each in its own short transaction"""
+
+    def _batch_ids(self, batch_size):
+        """Up to ``batch_size`` ids of the queryset, locked until the end
+        of the transaction where the database supports it"""
+        batch = self.order_by()
+        features = connections[self.db].features
+        if features.has_select_for_update_skip_locked:
+            batch = batch.select_for_update(skip_locked=True)
+        return list(batch.values_list('pk', flat=True)[:batch_size])
+
+    def move_to(self, model, batch_size=1000):
+        """Move the messages of the queryset to ``model``, an archive table
+        with the same fields, and return how many moved
+
+        Each batch is copied by an INSERT ... SELECT, without going through
+        Python, and deleted in the same transaction. Messages which are in
+        the archive already, from an earlier interrupted run, are only
+        deleted.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        names = [f.attname for f in model._meta.concrete_fields]
+        insert = 'INSERT INTO {} ({}) '.format(
+            qn(model._meta.db_table),
+            ', '.join(qn(model._meta.get_field(name).column)
+                      for name in names))
+        base = self.model._default_manager.using(self.db)
+        archive = model._default_manager.using(self.db)
+        moved = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                ids = self._batch_ids(batch_size)
+                if not ids:
+                    return moved
+                archived = set(archive.filter(pk__in=ids)
+                               .values_list('pk', flat=True))
+                fresh = [pk for pk in ids if pk not in archived]
+                if fresh:
+                    query = (base.filter(pk__in=fresh).order_by()
+                             .values_list(*names).query)
+                    select, params = query.get_compiler(self.db).as_sql()
+                    with connection.cursor() as cursor:
+                        cursor.execute(insert + select, params)
+                base.filter(pk__in=ids).delete()
+            moved += len(ids)
+
+    def purge(self, batch_size=1000):
+        """Delete the messages of the queryset and return how many were
+        deleted"""
+        base = self.model._default_manager.using(self.db)
+        deleted = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                ids = self._batch_ids(batch_size)
+                if not ids:
+                    return deleted
+                deleted += base.filter(pk__in=ids).delete()[0]
+
+
+class OutgoingMessageQuerySet(RetentionQuerySet):
     def outgoing(self):
-        return self.filter(sent=False)
+        """Messages waiting to be sent, oldest first
+
+        The ordering replaces the default '-created' one so that the scan
+        walks the partial index on queued messages instead of sorting.
+        """
+        return (self.filter(status=self.model.QUEUED)
+                .order_by('created'))
+
+    def claimed(self):
+        """Messages handed to a device, which didn't report them sent yet"""
+        return self.filter(status=self.model.CLAIMED)
+
+    def done(self):
+        """Messages the devices are done with: sent, delivered, failed or
+        expired"""
+        return self.filter(status_in(self.model.SENT, self.model.DELIVERED,
+                                     self.model.FAILED, self.model.EXPIRED))
+
+    def archivable(self):
+        """Messages which left the queue: those the devices are done with,
+        and those still claimed, which devices without the Results API
+        never report on"""
+        return self.filter(status_in(self.model.CLAIMED, self.model.SENT,
+                                     self.model.DELIVERED, self.model.FAILED,
+                                     self.model.EXPIRED))
+
+    def unacknowledged(self):
+        """Claimed messages the device didn't acknowledge yet"""
+        return self.claimed().filter(acknowledged_timestamp=None)
+
+    def awaiting_report(self):
+        """Messages handed to a device and not reported delivered or failed
+        yet, those whose results were asked for the longest ago first"""
+        return (self.filter(status_in(self.model.CLAIMED, self.model.SENT))
+                .order_by(report_order()))
+
+    def request_reports(self, limit):
+        """Return the ids of up to ``limit`` messages awaiting a report and
+        record that their results were asked for
+
+        Messages whose delivery is never reported, as when the carrier
+        sends no delivery reports, move to the back of the queue rather
+        than being asked about on every call.
+        """
+        with transaction.atomic(using=self.db):
+            ids = list(self.awaiting_report()
+                       .values_list('id', flat=True)[:limit])
+            self.filter(id__in=ids).update(
+                report_requested_timestamp=timezone.now())
+        return ids
+
+    def task_values(self):
+        """Only the columns needed to build a send task, as tuples
+
+        Numbers are read as the stored strings rather than parsed into
+        PhoneNumber instances, see smssync.numbers.format_number().
+        """
+        to = models.ExpressionWrapper(models.F('to'),
+                                      output_field=models.CharField())
+        return self.values_list('id', to, 'message')
+
+    def transition_fields(self, status, **fields):
+        """The fields to set on messages moving to ``status``, besides the
+        status itself: its timestamps and ``fields``"""
+        now = timezone.now()
+        fields.setdefault('status_timestamp', now)
+        timestamp = self.model.TRANSITION_TIMESTAMPS.get(status)
+        if timestamp:
+            fields.setdefault(timestamp, now)
+        return fields
+
+    def transition(self, status, **fields):
+        """Move the messages of the queryset to ``status`` along with
+        ``fields``, returns how many moved
 
+        Only the messages for which this is a valid transition move: the
+        current status is checked by the UPDATE itself rather than read
+        beforehand.
+        """
+        allowed = status_in(*self.model.TRANSITIONS[status])
+        return self.filter(allowed).update(
+            status=status, **self.transition_fields(status, **fields))
 
-class IncomingMessageQuerySet(models.QuerySet):
+    def transition_in_batches(self, status, batch_size=1000, **fields):
+        """Like transition(), with UPDATEs of up to ``batch_size`` rows so
+        that large transitions don't hold long locks
+
+        The ids of each batch are read first: MySQL doesn't allow a LIMIT
+        in a subquery of the table being updated.
+        """
+        allowed = status_in(*self.model.TRANSITIONS[status])
+        base = self.model._default_manager.using(self.db)
+        total = 0
+        while True:
+            ids = list(self.filter(allowed).order_by()
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return total
+            total += base.filter(id__in=ids).transition(status, **fields)
+
+    def retry(self, lease, max_attempts, batch_size=1000):
+        """Queue the unacknowledged messages whose claim is older than
+        their lease again, and expire those claimed ``max_attempts`` times
+        already. Returns the numbers of messages queued and expired.
+
+        The lease is ``lease`` seconds for the first attempt and doubles
+        with each of the following ones. Each attempt count is a range scan
+        of the partial index on unacknowledged claims.
+        """
+        now = timezone.now()
+        queued = expired = 0
+        for attempt in range(1, max_attempts + 1):
+            cutoff = now - datetime.timedelta(
+                seconds=lease * 2 ** (attempt - 1))
+            stale = self.unacknowledged().filter(claimed_timestamp__lt=cutoff)
+            if attempt < max_attempts:
+                queued += stale.filter(attempts=attempt).transition_in_batches(
+                    self.model.QUEUED, batch_size, claim_token=None)
+            else:
+                expired += stale.filter(
+                    attempts__gte=attempt).transition_in_batches(
+                        self.model.EXPIRED, batch_size)
+        return queued, expired
+
+    def expire(self, ttl, batch_size=1000):
+        """Expire the queued and claimed messages created more than ``ttl``
+        seconds ago and return how many expired"""
+        cutoff = timezone.now() - datetime.timedelta(seconds=ttl)
+        return self.filter(created__lt=cutoff).transition_in_batches(
+            self.model.EXPIRED, batch_size)
+
+    def resend(self):
+        """Queue the failed and expired messages of the queryset again, as
+        if they were new, and return how many were queued"""
+        return self.filter(
+            status_in(self.model.FAILED, self.model.EXPIRED)).transition(
+                self.model.QUEUED, claim_token=None, attempts=0,
+                acknowledged_timestamp=None)
+
+    def mark_as_sent(self):
+        """Flag every message in the queryset as sent with a single UPDATE"""
+        return self.transition(self.model.SENT)
+
+    def for_device(self, device_id):
+        """Messages routed to ``device_id``, or to no device in particular
+        if it is empty"""
+        return self.filter(device_id=device_id or '')
+
+    def claim(self, limit=None, device_id=None):
+        """Flag up to ``limit`` queued messages as claimed, oldest first,
+        and return them
+
+        Messages routed to ``device_id`` are claimed first, then messages
+        not routed to any device.
+
+        Concurrent callers never claim the same message and never wait for
+        each other. Where the database supports it, the queued rows are
+        locked with SELECT ... FOR UPDATE SKIP LOCKED so that other callers
+        move on to the next unlocked ones. Elsewhere (SQLite, MariaDB before
+        10.6) the UPDATE flagging the rows only moves those still queued,
+        so a caller racing another may claim fewer than ``limit``. Either
+        way the claimed rows are tagged with a fresh claim token which is
+        then used to read them back.
+        """
+        token = uuid.uuid4()
+        queues = [device_id, ''] if device_id else ['']
+
+        with transaction.atomic(using=self.db):
+            for queue in queues:
+                pending = self.outgoing().for_device(queue)
+                claimed = self._claim(pending, limit, token)
+                if limit is not None:
+                    limit -= claimed
+                    if limit <= 0:
+                        break
+
+        return self.model._default_manager.using(self.db).filter(
+            claim_token=token)
+
+    def _claim(self, pending, limit, token):
+        if connections[self.db].features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        # read beforehand, MySQL doesn't allow a LIMIT in a subquery of the
+        # table being updated. The conditional UPDATE skips those another
+        # caller claimed in the meantime.
+        ids = list(pending.values_list('id', flat=True)[:limit])
+        if not ids:
+            return 0
+        return self.filter(id__in=ids).transition(
+            self.model.CLAIMED,
+            claim_token=token,
+            attempts=models.F('attempts') + 1)
+
+    def acknowledge(self, ids):
+        """Record that the device queued the messages with the given ids
+        for sending and return the ids of those which exist"""
+        qs = self.filter(id__in=ids)
+        found = list(qs.values_list('id', flat=True))
+        qs.update(acknowledged_timestamp=timezone.now())
+        return found
+
+    def report_results(self, results):
+        """Record the sent and delivered results reported by a device
+
+        ``results`` is a list of dicts with the keys of SMSSync's
+        message_result entries. Messages sharing the same result are
+        updated together, with one conditional UPDATE per distinct result:
+        a successful sent report moves them to SENT, a successful delivery
+        report to DELIVERED and any error to FAILED. Sent reports are
+        applied before delivery reports.
+        """
+        now = timezone.now()
+        RESULT_OK = self.model.RESULT_OK
+        RESULT_NONE = self.model.RESULT_NONE
+        groups = {}
+        for result in results:
+            for report in ('sent', 'delivered'):
+                code = result.get('{}_result_code'.format(report))
+                if code is None or int(code) == RESULT_NONE:
+                    continue
+                message = result.get('{}_result_message'.format(report)) or ''
+                key = (report, int(code), message[:32])
+                groups.setdefault(key, []).append(result['uuid'])
+
+        success = {'sent': self.model.SENT,
+                   'delivered': self.model.DELIVERED}
+        with transaction.atomic(using=self.db):
+            for (report, code, message), ids in sorted(
+                    groups.items(), key=lambda group: group[0][0] != 'sent'):
+                prefix = 'sms_{}'.format(report)
+                status = success[report] if code == RESULT_OK \
+                    else self.model.FAILED
+                self.filter(id__in=ids).transition(status, **{
+                    prefix + '_result_code': code,
+                    prefix + '_result_message': message,
+                    prefix + '_report_timestamp': now})
+        return len(groups)
+
+    def pending_counts(self, devices):
+        """Map each of ``devices`` to its number of pending messages"""
+        counts = dict.fromkeys(devices, 0)
+        rows = (self.outgoing().filter(device_id__in=devices).order_by()
+                .values_list('device_id').annotate(count=models.Count('id')))
+        counts.update(rows)
+        return counts
+
+
+class IncomingMessageQuerySet(RetentionQuerySet):
     def incoming(self):
-        return self.filter(received=False)
+        """Messages not received yet, oldest first
+
+        As with OutgoingMessageQuerySet.outgoing(), the ordering matches
+        the partial index on pending messages.
+        """
+        return self.filter(received=False).order_by('created')
+
+    def received(self):
+        """Messages already received"""
+        return self.filter(received=True)
 
     def sent_from(self, sent_from):
         return self.filter(sent_from=sent_from)
+
+    def mark_as_received(self):
+        """Flag every message in the queryset as received with a single
+        UPDATE"""
+        return self.update(received=True, received_timestamp=timezone.now())
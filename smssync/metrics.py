@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+from collections import Counter, defaultdict
+from functools import lru_cache, wraps
+import logging
+import socket
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from smssync.backends import get_backend
+from smssync.conf import get_setting
+from smssync.numbers import cache_info
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    """Receives the measurements taken by smssync, which subclasses export
+
+    Counters are per device, with a ``device_id`` label. Timers are in
+    seconds. Gauges are measured on demand by collect_gauges() rather than
+    on the request path. Methods are called while serving the devices, so
+    they must be quick and must not raise.
+    """
+
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def timing(self, name, seconds, labels=None):
+        pass
+
+    def gauge(self, name, value, labels=None):
+        pass
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class PrometheusMetrics(Metrics):
+    """Keep the measurements in memory, rendered in the Prometheus text
+    format by the smssync.views.metrics view
+
+    Measurements are per process: with several worker processes, each
+    scrape only sees the process which served it. Use StatsdMetrics then.
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timers = defaultdict(lambda: [0, 0.0])
+        self._gauges = {}
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] += value
+
+    def timing(self, name, seconds, labels=None):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            timer = self._timers[key]
+            timer[0] += 1
+            timer[1] += seconds
+
+    def gauge(self, name, value, labels=None):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def _samples(self, name, labels, value):
+        if labels:
+            name += '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                                   for k, v in labels) + '}'
+        return '{} {}'.format(name, value)
+
+    def render(self):
+        """Collect the gauges and return every measurement as Prometheus
+        text"""
+        collect_gauges(self)
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted((key, tuple(timer))
+                            for key, timer in self._timers.items())
+            gauges = sorted(self._gauges.items())
+
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            name = 'smssync_{}_total'.format(name)
+            declare(name, 'counter')
+            lines.append(self._samples(name, labels, value))
+        for (name, labels), (count, total) in timers:
+            name = 'smssync_{}_seconds'.format(name)
+            declare(name, 'summary')
+            lines.append(self._samples(name + '_count', labels, count))
+            lines.append(self._samples(name + '_sum', labels, total))
+        for (name, labels), value in gauges:
+            name = 'smssync_{}'.format(name)
+            declare(name, 'gauge')
+            lines.append(self._samples(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(Metrics):
+    """Send the measurements to the StatsD daemon at SMSSYNC_STATSD_ADDRESS,
+    one UDP datagram each, named after SMSSYNC_STATSD_PREFIX
+
+    Label values are appended to the names, e.g.
+    ``smssync.messages_sent.<device_id>``. Gauges are sent by the
+    smssync_metrics management command.
+    """
+
+    def __init__(self):
+        self.prefix = get_setting('SMSSYNC_STATSD_PREFIX')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        try:
+            # resolves the address once and for all
+            self.socket.connect(get_setting('SMSSYNC_STATSD_ADDRESS'))
+        except OSError as e:
+            logger.warning("Not sending metrics to StatsD: {}".format(e))
+            self.socket = None
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name]
+        for key, value in _labels_key(labels):
+            if value:
+                parts.append(str(value))
+        return '.'.join(p.replace(':', '_').replace('|', '_').replace('@', '_')
+                        for p in parts if p)
+
+    def _send(self, name, labels, value, kind):
+        if self.socket is None:
+            return
+        try:
+            self.socket.send('{}:{}|{}'.format(self._name(name, labels),
+                                               value, kind).encode())
+        except OSError:
+            # nobody listening or buffer full, measurements are best effort
+            pass
+
+    def increment(self, name, value=1, labels=None):
+        self._send(name, labels, value, 'c')
+
+    def timing(self, name, seconds, labels=None):
+        self._send(name, labels, '{:.3f}'.format(seconds * 1000), 'ms')
+
+    def gauge(self, name, value, labels=None):
+        self._send(name, labels, value, 'g')
+
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    """Return the Metrics selected by SMSSYNC_METRICS, None if disabled"""
+    path = get_setting('SMSSYNC_METRICS')
+    if not path:
+        return None
+    return import_string(path)()
+
+
+@receiver(setting_changed)
+def _reset_metrics(setting, **kwargs):
+    if setting in ('SMSSYNC_METRICS', 'SMSSYNC_STATSD_ADDRESS',
+                   'SMSSYNC_STATSD_PREFIX'):
+        get_metrics.cache_clear()
+
+
+def timed(name):
+    """Decorator timing each call to the function, unless metrics are
+    disabled"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics = get_metrics()
+            if metrics is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.timing(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def increment(name, value=1, device_id=None):
+    """Add ``value`` to the counter ``name`` of ``device_id``"""
+    metrics = get_metrics()
+    if metrics is not None and value:
+        metrics.increment(name, value, {'device_id': device_id or ''})
+
+
+def count_messages(name, messages):
+    """Add the messages to the counter ``name`` of their devices"""
+    metrics = get_metrics()
+    if metrics is not None:
+        for device_id, count in Counter(m.device_id for m in messages).items():
+            metrics.increment(name, count, {'device_id': device_id or ''})
+
+
+def collect_gauges(metrics):
+    """Measure the depth of the message queues and the state of the phone
+    number caches, too costly to follow on every request"""
+    for queue, depth in get_backend().queue_depths().items():
+        metrics.gauge('queue_depth', depth, {'queue': queue})
+    for cache, info in cache_info().items():
+        for key in ('hits', 'misses', 'size'):
+            metrics.gauge('number_cache_' + key, info[key], {'cache': cache})
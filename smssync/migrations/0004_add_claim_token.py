@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0003_remove_message_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='claim_token',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0004_add_claim_token'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(condition=models.Q(('received', False)), fields=['created'], name='smssync_in_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(condition=models.Q(('received', False)), fields=['sent_from', 'created'], name='smssync_in_sender_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('sent', False)), fields=['created'], name='smssync_out_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0005_add_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outgoingmessage',
+            name='smssync_out_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='device_id',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('sent', False)), fields=['device_id', 'created'], name='smssync_out_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:15
+
+from django.db import migrations, models
+from django.db.models import F
+from django.db.models.functions import Coalesce
+
+
+def set_status(apps, schema_editor):
+    """Messages flagged as sent were handed to a device, which is all the
+    sent flag recorded: they are considered sent"""
+    OutgoingMessage = apps.get_model('smssync', 'OutgoingMessage')
+    OutgoingMessage.objects.filter(sent=True).update(
+        status=2,
+        status_timestamp=F('sent_timestamp'),
+        claimed_timestamp=F('sent_timestamp'))
+
+
+def set_sent(apps, schema_editor):
+    """Flag every message which left the queue as sent, so that rolling
+    back doesn't hand it to the devices again"""
+    OutgoingMessage = apps.get_model('smssync', 'OutgoingMessage')
+    OutgoingMessage.objects.exclude(status=0).update(
+        sent=True,
+        sent_timestamp=Coalesce('sent_timestamp', 'claimed_timestamp',
+                                'status_timestamp'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0006_add_outgoing_device_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='acknowledged_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_delivered_report_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_delivered_result_code',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_delivered_result_message',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_sent_report_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_sent_result_code',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='sms_sent_result_message',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='claimed_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'queued'), (1, 'claimed'), (2, 'sent'), (3, 'delivered'), (4, 'failed'), (5, 'expired')], default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='status_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_status, set_sent),
+        migrations.RemoveIndex(
+            model_name='outgoingmessage',
+            name='smssync_out_queue_idx',
+        ),
+        migrations.RemoveField(
+            model_name='outgoingmessage',
+            name='sent',
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status', 0)), fields=['device_id', 'created'], name='smssync_out_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status__in', [1, 2])), fields=['claimed_timestamp'], name='smssync_out_report_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0007_add_outgoing_status'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outgoingmessage',
+            name='smssync_out_report_idx',
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status', 1), ('status', 2), _connector='OR'), fields=['claimed_timestamp'], name='smssync_out_report_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('acknowledged_timestamp', None), ('status', 1)), fields=['attempts', 'claimed_timestamp'], name='smssync_out_lease_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status', 0), ('status', 1), _connector='OR'), fields=['created'], name='smssync_out_live_idx'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import phonenumber_field.modelfields
+import smssync.models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0008_add_retry_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedIncomingMessage',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('message', models.CharField(blank=True, max_length=160)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('sent_from', phonenumber_field.modelfields.PhoneNumberField(max_length=128, region=None)),
+                ('sent_to', models.CharField(blank=True, max_length=32)),
+                ('device_id', models.CharField(blank=True, max_length=32)),
+                ('sent_timestamp', models.DateTimeField()),
+                ('received', models.BooleanField(default=False, editable=False)),
+                ('received_timestamp', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'abstract': False,
+            },
+            bases=(smssync.models.MessageBase, models.Model),
+        ),
+        migrations.CreateModel(
+            name='ArchivedOutgoingMessage',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('message', models.CharField(blank=True, max_length=160)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('to', phonenumber_field.modelfields.PhoneNumberField(editable=False, max_length=128, region=None)),
+                ('device_id', models.CharField(blank=True, default='', max_length=32)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'queued'), (1, 'claimed'), (2, 'sent'), (3, 'delivered'), (4, 'failed'), (5, 'expired')], default=0, editable=False)),
+                ('status_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('claimed_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('sent_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0, editable=False)),
+                ('claim_token', models.UUIDField(blank=True, db_index=True, editable=False, null=True)),
+                ('acknowledged_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('sms_sent_result_code', models.IntegerField(blank=True, null=True)),
+                ('sms_sent_result_message', models.CharField(blank=True, max_length=32, null=True)),
+                ('sms_sent_report_timestamp', models.DateTimeField(blank=True, null=True)),
+                ('sms_delivered_result_code', models.IntegerField(blank=True, null=True)),
+                ('sms_delivered_result_message', models.CharField(blank=True, max_length=32, null=True)),
+                ('sms_delivered_report_timestamp', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'abstract': False,
+            },
+            bases=(smssync.models.MessageBase, models.Model),
+        ),
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(condition=models.Q(('received', True)), fields=['created'], name='smssync_in_done_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status', 2), ('status', 3), ('status', 4), ('status', 5), _connector='OR'), fields=['created'], name='smssync_out_done_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedoutgoingmessage',
+            index=models.Index(fields=['created'], name='smssync_out_archive_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedincomingmessage',
+            index=models.Index(fields=['created'], name='smssync_in_archive_idx'),
+        ),
+    ]
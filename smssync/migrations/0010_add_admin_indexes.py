@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0009_add_archive'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(fields=['created', 'id'], name='smssync_in_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='incomingmessage',
+            index=models.Index(fields=['device_id', 'created'], name='smssync_in_device_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(fields=['created', 'id'], name='smssync_out_created_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:55
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0010_add_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outgoingmessage',
+            name='smssync_out_report_idx',
+        ),
+        migrations.AddField(
+            model_name='archivedoutgoingmessage',
+            name='report_requested_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='outgoingmessage',
+            name='report_requested_timestamp',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(django.db.models.functions.comparison.Coalesce('report_requested_timestamp', 'claimed_timestamp'), condition=models.Q(('status', 1), ('status', 2), _connector='OR'), name='smssync_out_report_idx'),
+        ),
+    ]
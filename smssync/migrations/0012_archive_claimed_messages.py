@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smssync', '0011_add_report_requested'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outgoingmessage',
+            name='smssync_out_done_idx',
+        ),
+        migrations.AddIndex(
+            model_name='outgoingmessage',
+            index=models.Index(condition=models.Q(('status', 1), ('status', 2), ('status', 3), ('status', 4), ('status', 5), _connector='OR'), fields=['created'], name='smssync_out_dequeued_idx'),
+        ),
+    ]
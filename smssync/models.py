@@ -20,11 +20,15 @@
 import uuid
 import datetime
 
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
 from phonenumber_field.modelfields import PhoneNumberField
 
-from smssync.managers import IncomingMessageQuerySet, OutgoingMessageQuerySet
+from smssync.managers import (IncomingMessageQuerySet, OutgoingMessageQuerySet,
+                              RetentionQuerySet, report_order, status_in)
+from smssync.notify import notify_outgoing
+from smssync.numbers import format_number, parse_number
 
 from django.utils.formats import get_format
 datetime_formats = get_format('DATETIME_INPUT_FORMATS')
@@ -53,9 +57,11 @@ class Message(MessageBase, models.Model):
         ordering = ['-created']
 
 
-class IncomingMessage(Message):
+class IncomingMessageBase(Message):
+    """Fields of the incoming messages, live or archived"""
 
-    objects = IncomingMessageQuerySet.as_manager()
+    class Meta(Message.Meta):
+        abstract = True
 
     sent_from = PhoneNumberField(blank=False)
 
@@ -77,6 +83,34 @@ class IncomingMessage(Message):
     received_timestamp = models.DateTimeField(null=True,
                                               blank=True)
 
+
+class IncomingMessage(IncomingMessageBase):
+
+    objects = IncomingMessageQuerySet.as_manager()
+
+    class Meta(IncomingMessageBase.Meta):
+        indexes = [
+            # queue scans of IncomingMessageQuerySet.incoming()
+            models.Index(fields=['created'],
+                         name='smssync_in_pending_idx',
+                         condition=models.Q(received=False)),
+            # IncomingMessageQuerySet.incoming().sent_from()
+            models.Index(fields=['sent_from', 'created'],
+                         name='smssync_in_sender_idx',
+                         condition=models.Q(received=False)),
+            # IncomingMessageQuerySet.received(), for smssync_archive
+            models.Index(fields=['created'],
+                         name='smssync_in_done_idx',
+                         condition=models.Q(received=True)),
+            # admin change lists, paginated by (created, id) and filtered
+            # by device. There is no full index on sent_from, which SQLite
+            # would pick over smssync_in_sender_idx for the queue scans.
+            models.Index(fields=['created', 'id'],
+                         name='smssync_in_created_idx'),
+            models.Index(fields=['device_id', 'created'],
+                         name='smssync_in_device_idx'),
+        ]
+
     REQUIRED_KEYWORDS = ['from',
                          'message',
                          'sent_timestamp',
@@ -96,25 +130,48 @@ class IncomingMessage(Message):
                             .format(", ".join(missing)))
 
     @classmethod
-    def create(cls, **kwargs):
+    def build(cls, **kwargs):
+        """Validate the parameters sent by the device and return an unsaved
+        message
+
+        Raises ValidationError for values the database would reject, like
+        over long messages, and for out of range timestamps. Senders which
+        aren't valid phone numbers, such as short codes and alphanumeric
+        senders, are kept as sent.
+        """
         cls.validate_before(kwargs)
         # looks like timestamp is in microsecs
-        millis = float(kwargs.get('sent_timestamp'))/1000
-        sent_timestamp = datetime.datetime.fromtimestamp(millis)
-        message = cls(sent_from=kwargs.get('from'),
+        try:
+            millis = float(kwargs.get('sent_timestamp'))/1000
+            sent_timestamp = datetime.datetime.fromtimestamp(millis)
+        except (ValueError, OverflowError, OSError):
+            raise ValidationError("Invalid sent_timestamp: {}".format(
+                kwargs.get('sent_timestamp')))
+        message = cls(sent_from=parse_number(kwargs.get('from')),
                       message=kwargs.get('message'),
                       sent_timestamp=sent_timestamp,
                       # uuid already set by app
-                      id=kwargs.get('message_id'),
+                      id=cls._meta.pk.to_python(kwargs.get('message_id')),
                       sent_to=kwargs.get('sent_to',""),
                       device_id=kwargs.get('device_id',""),
         )
+        message.full_clean(exclude=['id', 'sent_from'],
+                           validate_unique=False)
+        max_length = cls._meta.get_field('sent_from').max_length
+        if len(kwargs.get('from')) > max_length:
+            raise ValidationError("Sender must have at most {} characters"
+                                  .format(max_length))
+        return message
+
+    @classmethod
+    def create(cls, **kwargs):
+        message = cls.build(**kwargs)
         try:
             message.save()
         except:
             raise
         return message
-        
+
     def mark_as_received(self):
         self.received = True
         self.received_timestamp = timezone.now()
@@ -122,61 +179,220 @@ class IncomingMessage(Message):
         return self
 
 
-class OutgoingMessage(Message):
-
-    objects = OutgoingMessageQuerySet.as_manager()
+class OutgoingMessageBase(Message):
+    """Fields of the outgoing messages, live or archived"""
+
+    # lifecycle of a message: queued on the server, claimed by a device
+    # polling for messages to send, then sent and delivered, or failed, as
+    # reported by the device. Messages which can't be sent in time expire.
+    QUEUED = 0
+    CLAIMED = 1
+    SENT = 2
+    DELIVERED = 3
+    FAILED = 4
+    EXPIRED = 5
+
+    STATUS_CHOICES = (
+        (QUEUED, "queued"),
+        (CLAIMED, "claimed"),
+        (SENT, "sent"),
+        (DELIVERED, "delivered"),
+        (FAILED, "failed"),
+        (EXPIRED, "expired"),
+    )
+
+    # the statuses each status can be reached from
+    TRANSITIONS = {
+        QUEUED: (CLAIMED, FAILED, EXPIRED),
+        CLAIMED: (QUEUED,),
+        SENT: (QUEUED, CLAIMED),
+        DELIVERED: (CLAIMED, SENT),
+        FAILED: (CLAIMED, SENT),
+        EXPIRED: (QUEUED, CLAIMED),
+    }
+
+    # fields set to the time of the transition, besides status_timestamp
+    TRANSITION_TIMESTAMPS = {
+        CLAIMED: 'claimed_timestamp',
+        SENT: 'sent_timestamp',
+    }
+
+    class Meta(Message.Meta):
+        abstract = True
 
     to = PhoneNumberField(null=False,
                           blank=False,
                           editable=False)
 
+    # the device which should send the message, any device if empty
+    device_id = models.CharField(max_length=32,
+                                 null=False,
+                                 blank=True,
+                                 default="")
+
     #in_reply_to = models.ForeignKey(IncomingMessage,
     #                             related_name="replies")
 
-    sent = models.BooleanField(default=False,
-                               null=False,
-                               editable=False)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES,
+                                              default=QUEUED,
+                                              null=False,
+                                              editable=False)
+
+    # when the message entered its current status
+    status_timestamp = models.DateTimeField(null=True,
+                                            blank=True)
+
+    claimed_timestamp = models.DateTimeField(null=True,
+                                             blank=True)
 
     sent_timestamp = models.DateTimeField(null=True,
                                           blank=True)
 
-    """ Fields below will be needed for Results API """
-
-    # queued = models.BooleanField(default=False)
-    # queued_timestamp = models.DateTimeField(null=False)
-    #
-    # sms_sent = models.BooleanField(null=False, default=False)
-    # sms_sent_result_code = models.IntegerField(null=True)
-    # sms_sent_result_message = models.CharField(max_length=32,
-    #                                        null=True,
-    #                                        blank=True)
-    # sms_sent_report_timestamp = models.DateTimeField(null=True)
-    
-    # sms_delivered = models.BooleanField(null=False, default=False)
-    # sms_delivered_result_code = models.IntegerField(null=True)
-    # sms_delivered_result_message = models.CharField(max_length=32,
-    #                                             null=True,
-    #                                             blank=True)
-    # sms_delivered_report_timestamp = models.DateTimeField(null=True)
+    # number of times the message was claimed
+    attempts = models.PositiveSmallIntegerField(default=0,
+                                                null=False,
+                                                editable=False)
 
+    # set by OutgoingMessageQuerySet.claim() to find the rows it claimed
+    claim_token = models.UUIDField(null=True,
+                                   blank=True,
+                                   editable=False,
+                                   db_index=True)
+
+    """ Fields below are set through the Results API """
+
+    # the device acknowledged it queued the message for sending
+    acknowledged_timestamp = models.DateTimeField(null=True,
+                                                  blank=True)
+
+    sms_sent_result_code = models.IntegerField(null=True,
+                                               blank=True)
+    sms_sent_result_message = models.CharField(max_length=32,
+                                               null=True,
+                                               blank=True)
+    sms_sent_report_timestamp = models.DateTimeField(null=True,
+                                                     blank=True)
+
+    sms_delivered_result_code = models.IntegerField(null=True,
+                                                    blank=True)
+    sms_delivered_result_message = models.CharField(max_length=32,
+                                                    null=True,
+                                                    blank=True)
+    sms_delivered_report_timestamp = models.DateTimeField(null=True,
+                                                          blank=True)
+
+    # the result task last asked the device for the results of the message
+    report_requested_timestamp = models.DateTimeField(null=True,
+                                                      blank=True,
+                                                      editable=False)
+
+    # result codes are Android's: Activity.RESULT_OK for success, 0 when
+    # there is nothing to report yet and SmsManager.RESULT_ERROR_* codes
+    RESULT_OK = -1
+    RESULT_NONE = 0
+
+
+class OutgoingMessage(OutgoingMessageBase):
+
+    objects = OutgoingMessageQuerySet.as_manager()
+
+    class Meta(OutgoingMessageBase.Meta):
+        indexes = [
+            # queue scans of OutgoingMessageQuerySet.outgoing().for_device()
+            models.Index(fields=['device_id', 'created'],
+                         name='smssync_out_queue_idx',
+                         condition=models.Q(status=0)),  # QUEUED
+            # OutgoingMessageQuerySet.awaiting_report()
+            models.Index(report_order(),
+                         name='smssync_out_report_idx',
+                         # CLAIMED, SENT
+                         condition=status_in(1, 2)),
+            # OutgoingMessageQuerySet.retry()
+            models.Index(fields=['attempts', 'claimed_timestamp'],
+                         name='smssync_out_lease_idx',
+                         # CLAIMED
+                         condition=models.Q(status=1,
+                                            acknowledged_timestamp=None)),
+            # OutgoingMessageQuerySet.expire()
+            models.Index(fields=['created'],
+                         name='smssync_out_live_idx',
+                         # QUEUED, CLAIMED
+                         condition=status_in(0, 1)),
+            # OutgoingMessageQuerySet.archivable(), for smssync_archive
+            models.Index(fields=['created'],
+                         name='smssync_out_dequeued_idx',
+                         # CLAIMED, SENT, DELIVERED, FAILED, EXPIRED
+                         condition=status_in(1, 2, 3, 4, 5)),
+            # admin change lists, paginated by (created, id). There is no
+            # full index on device_id, which SQLite would pick over the
+            # queue index for claims.
+            models.Index(fields=['created', 'id'],
+                         name='smssync_out_created_idx'),
+        ]
 
     @classmethod
-    def create(cls, text, to):
-        message = cls(to=to,
-                      message=text)
+    def create(cls, text, to, device_id=""):
+        message = cls(to=parse_number(to),
+                      message=text,
+                      device_id=device_id)
         try:
             message.save()
         except:
             raise
+        notify_outgoing()
         return message
 
+    def transition(self, status, **fields):
+        """Move the message to ``status`` if it is a valid transition from
+        its status in the database, returns whether it moved
+
+        The check and the change are done by one conditional UPDATE, so
+        concurrent transitions of the same message can't both succeed.
+        """
+        qs = type(self)._default_manager.filter(pk=self.pk)
+        fields = qs.transition_fields(status, **fields)
+        moved = qs.transition(status, **fields)
+        if moved:
+            self.status = status
+            for name, value in fields.items():
+                setattr(self, name, value)
+        return bool(moved)
+
     def mark_as_sent(self):
-        self.sent = True
-        self.sent_timestamp = timezone.now()
-        self.save()
+        return self.transition(self.SENT)
+
+    @staticmethod
+    def make_task_dict(id, to, message):
+        return {'to': format_number(to),
+                'message': message,
+                'uuid': id,}
 
     @property
     def task_dict(self):
-        return {'to': str(self.to),
-                'message': self.message,
-                'uuid': self.id,}
+        return self.make_task_dict(self.id, self.to, self.message)
+
+
+class ArchivedIncomingMessage(IncomingMessageBase):
+    """Received messages moved out of IncomingMessage by the smssync_archive
+    management command"""
+
+    objects = RetentionQuerySet.as_manager()
+
+    class Meta(IncomingMessageBase.Meta):
+        indexes = [
+            models.Index(fields=['created'],
+                         name='smssync_in_archive_idx'),
+        ]
+
+
+class ArchivedOutgoingMessage(OutgoingMessageBase):
+    """Messages done with, moved out of OutgoingMessage by the
+    smssync_archive management command"""
+
+    objects = RetentionQuerySet.as_manager()
+
+    class Meta(OutgoingMessageBase.Meta):
+        indexes = [
+            models.Index(fields=['created'],
+                         name='smssync_out_archive_idx'),
+        ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+
+from django.db import transaction
+
+
+class Notifier(object):
+    """Wake up pollers, sync or async, waiting for something to happen
+
+    Waiters pass the ``version`` they read before checking for work, so
+    that a notification sent between that check and the wait is not lost.
+    Notifications don't cross process boundaries: pollers in other
+    processes only notice new work when their wait times out.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._futures = set()
+        self.version = 0
+
+    def notify(self):
+        with self._lock:
+            self.version += 1
+            self._condition.notify_all()
+            futures, self._futures = self._futures, set()
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_set_done, future)
+
+    def wait(self, timeout, since):
+        """Block until notify() is called, or was called since ``version``
+        was ``since``, for at most ``timeout`` seconds
+
+        Return whether a notification was received.
+        """
+        with self._lock:
+            return self._condition.wait_for(lambda: self.version != since,
+                                            timeout)
+
+    async def async_wait(self, timeout, since):
+        """Coroutine version of wait()"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self.version != since:
+                return True
+            self._futures.add((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._futures.discard((loop, future))
+        return True
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# notified whenever new outgoing messages are committed
+outgoing = Notifier()
+
+
+def notify_outgoing(using=None):
+    """Wake up the devices waiting for outgoing messages once the current
+    transaction commits"""
+    transaction.on_commit(outgoing.notify, using=using)
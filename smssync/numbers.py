@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+from functools import lru_cache
+import threading
+
+import phonenumbers
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from phonenumber_field.phonenumber import PhoneNumber
+
+from smssync.conf import get_setting
+
+
+class CachedPhoneNumber(PhoneNumber):
+    """PhoneNumber remembering its validity and formats
+
+    Instances are shared by every message with the same number through the
+    cache, so they must not be modified.
+    """
+
+    def is_valid(self):
+        try:
+            return self._valid
+        except AttributeError:
+            self._valid = super(CachedPhoneNumber, self).is_valid()
+            return self._valid
+
+    def format_as(self, format):
+        try:
+            formats = self._formats
+        except AttributeError:
+            formats = self._formats = {}
+        if format not in formats:
+            formats[format] = super(CachedPhoneNumber, self).format_as(format)
+        return formats[format]
+
+
+def _parse(raw, region):
+    try:
+        return CachedPhoneNumber.from_string(phone_number=raw, region=region)
+    except phonenumbers.NumberParseException:
+        return CachedPhoneNumber(raw_input=raw)
+
+
+def _format(raw, region):
+    return str(parse_number(raw, region))
+
+
+_lock = threading.Lock()
+_caches = {}
+
+
+def _get_cached(func):
+    """Return the LRU cached version of ``func``, created on first use with
+    SMSSYNC_NUMBER_CACHE_SIZE entries"""
+    cached = _caches.get(func)
+    if cached is None:
+        with _lock:
+            cached = _caches.get(func)
+            if cached is None:
+                size = get_setting('SMSSYNC_NUMBER_CACHE_SIZE')
+                cached = _caches[func] = lru_cache(maxsize=size)(func)
+    return cached
+
+
+def _region(region):
+    if region is None:
+        return getattr(settings, 'PHONENUMBER_DEFAULT_REGION', None)
+    return region
+
+
+def parse_number(value, region=None):
+    """Return ``value`` as a PhoneNumber, parsing strings once per
+    (string, region) pair
+
+    Values which aren't strings, like PhoneNumber instances and None, are
+    returned as is. Like phonenumber_field's to_python(), invalid numbers
+    are kept as their raw input.
+    """
+    if not isinstance(value, str) or not value:
+        return value
+    return _get_cached(_parse)(value, _region(region))
+
+
+def format_number(value, region=None):
+    """Return the string handed to the devices for a number, a PhoneNumber
+    or a string as stored in the database
+
+    Numbers are formatted with PHONENUMBER_DEFAULT_FORMAT, once per distinct
+    string. With SMSSYNC_E164_NUMBERS they are E.164 instead, and when
+    numbers are stored in E.164 too (the default PHONENUMBER_DB_FORMAT),
+    stored strings are handed out as they are, without parsing them.
+    """
+    e164 = get_setting('SMSSYNC_E164_NUMBERS')
+    if not isinstance(value, str):
+        if e164 and value.is_valid():
+            return value.as_e164
+        return str(value)
+    if e164 and getattr(settings, 'PHONENUMBER_DB_FORMAT', 'E164') == 'E164':
+        return value
+    return _get_cached(_format)(value, _region(region))
+
+
+def cache_info():
+    """Hits, misses and sizes of the parsing and formatting caches"""
+    info = {}
+    for name, func in (('parse', _parse), ('format', _format)):
+        cached = _caches.get(func)
+        hits, misses, maxsize, currsize = (cached.cache_info() if cached
+                                           else (0, 0, None, 0))
+        lookups = hits + misses
+        info[name] = {'hits': hits,
+                      'misses': misses,
+                      'hit_rate': hits / lookups if lookups else 0.0,
+                      'size': currsize,
+                      'maxsize': maxsize}
+    return info
+
+
+def clear_cache():
+    with _lock:
+        _caches.clear()
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    if setting in ('SMSSYNC_NUMBER_CACHE_SIZE', 'PHONENUMBER_DEFAULT_REGION',
+                   'PHONENUMBER_DEFAULT_FORMAT', 'PHONENUMBER_DB_FORMAT'):
+        clear_cache()
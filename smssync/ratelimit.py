@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# (C) 2016 Rodrigo Rodrigues da Silva <pitanga@members.fsf.org>
+#
+# This file is part of django-smssync
+#
+# django-smssync is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# django-smssync is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.cache import caches
+
+from smssync.conf import get_setting
+
+
+class TokenBucket(object):
+    """Token bucket holding up to ``capacity`` tokens, refilled at a rate
+    of ``capacity`` tokens per ``period`` seconds
+
+    The state of the bucket is kept in the cache under ``key``, as a
+    (tokens, timestamp) pair.
+    """
+    def __init__(self, key, capacity, period):
+        self.key = key
+        self.capacity = capacity
+        self.period = period
+
+    def tokens(self, state, now):
+        """Number of tokens in the bucket at ``now``, given its last
+        cached ``state``"""
+        if state is None:
+            return self.capacity
+        tokens, timestamp = state
+        refill = (now - timestamp) * self.capacity / self.period
+        return min(self.capacity, tokens + refill)
+
+
+class RateLimiter(object):
+    """Per device limits on the number of messages handed out, with one
+    token bucket per configured limit
+
+    The buckets of a device are read and written with one cache call each.
+    Concurrent polls from the same device may both spend the same tokens,
+    which SMSSync doesn't do.
+    """
+    PERIODS = (('SMSSYNC_RATE_LIMIT_PER_MINUTE', 'minute', 60),
+               ('SMSSYNC_RATE_LIMIT_PER_HOUR', 'hour', 3600))
+
+    def __init__(self):
+        self.cache = caches[get_setting('SMSSYNC_RATE_LIMIT_CACHE')]
+
+    def buckets(self, device_id):
+        buckets = []
+        for setting, name, period in self.PERIODS:
+            capacity = get_setting(setting)
+            if capacity is not None:
+                key = 'smssync:ratelimit:{}:{}'.format(name, device_id or '')
+                buckets.append(TokenBucket(key, capacity, period))
+        return buckets
+
+    def allowance(self, device_id):
+        """Number of messages ``device_id`` may get now, None if it isn't
+        limited"""
+        buckets = self.buckets(device_id)
+        if not buckets:
+            return None
+        states = self.cache.get_many([b.key for b in buckets])
+        now = time.time()
+        return min(int(b.tokens(states.get(b.key), now)) for b in buckets)
+
+    def consume(self, device_id, count):
+        """Take ``count`` tokens from the buckets of ``device_id``"""
+        buckets = self.buckets(device_id)
+        if not buckets or not count:
+            return
+        states = self.cache.get_many([b.key for b in buckets])
+        now = time.time()
+        # any bucket is full again once its period has elapsed, and a full
+        # bucket needs no state
+        self.cache.set_many({b.key: (b.tokens(states.get(b.key), now) - count,
+                                     now)
+                             for b in buckets},
+                            timeout=max(b.period for b in buckets))
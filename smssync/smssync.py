@@ -19,29 +19,79 @@
 
 from django.apps import apps
 
+from smssync.backends import get_backend
+from smssync.handlers import Handler, receive_handlers
+from smssync.keywords import KeywordRouter
+
 OutgoingMessage = apps.get_model(app_label='smssync',
                                  model_name='OutgoingMessage')
 IncomingMessage = apps.get_model(app_label='smssync',
                                  model_name='IncomingMessage')
 
-def send(text, to):
-    om = OutgoingMessage.create(text, to)
-    try:
-        om.save()
-    except Exception:
-        raise
-    else:
-        return om
+def send(text, to, device_id=None):
+    """Queue a message, to be sent by ``device_id`` or by the device
+    SMSSYNC_ROUTER picks"""
+    return get_backend().send(text, to, device_id)
+
+
+def send_many(messages, batch_size=None, device_id=None):
+    """Queue many messages at once and return their ids
+
+    ``messages`` is an iterable of (text, to) pairs, consumed lazily and
+    stored ``batch_size`` (SMSSYNC_SEND_MANY_BATCH_SIZE by default) at a
+    time.
+    """
+    return get_backend().send_many(messages, batch_size, device_id)
 
 
 def receive(sent_from=None):
-    qs = IncomingMessage.objects.incoming()
-    if sent_from:
-        qs = qs.sent_from(sent_from)
-    for m in qs:
-        yield m.mark_as_received()
-    return
+    return get_backend().receive(sent_from)
+
+
+def receive_batches(batch_size=100, sent_from=None):
+    """Yield lists of up to ``batch_size`` incoming messages, oldest first
+
+    Each batch is marked as received once the consumer asks for the next
+    one. A consumer that stops or crashes halfway through a batch gets it
+    again on the next call.
+    """
+    return get_backend().receive_batches(batch_size, sent_from)
+
+
+def retry(batch_size=1000):
+    """Queue again the messages claimed by devices which didn't
+    acknowledge them in time and expire stale ones
+
+    Meant to be called periodically, see the smssync_retry command.
+    Returns the numbers of messages queued and expired.
+    """
+    return get_backend().retry(batch_size)
+
+
+def register_receive_handler(handler=None, sent_from=None, prefix=None,
+                             regex=None):
+    """Call ``handler`` with each incoming message matching all of the
+    ``sent_from`` number, the case insensitive keyword ``prefix`` and the
+    ``regex``, any message if none is given
+
+    Handlers run in background threads once the device got its response
+    (see smssync.handlers). Messages are marked as received once their
+    handlers ran without error, so receive() only yields the others.
+    Without ``handler``, returns a decorator registering the function it
+    decorates. ``handler`` may also be a smssync.keywords.KeywordRouter,
+    which routes messages on its own.
+    """
+    def register(func):
+        if isinstance(func, KeywordRouter):
+            receive_handlers.register(func)
+        else:
+            receive_handlers.register(Handler(func, sent_from, prefix, regex))
+        return func
+
+    if handler is None:
+        return register
+    return register(handler)
 
 
-def register_receive_handler():
-    pass
+def unregister_receive_handler(handler):
+    receive_handlers.unregister(handler)
@@ -18,45 +18,104 @@
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.test import TestCase, RequestFactory, Client
-from django.core.urlresolvers import reverse_lazy
+import hmac
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.http import Http404, HttpRequest
+from django.test import (TestCase, TransactionTestCase, RequestFactory,
+                         Client, override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse_lazy
 from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils import timezone
 
 from model_mommy import mommy
+import phonenumbers
+
+from smssync import smssync
+from smssync.admin import EstimatedCountPaginator, OutgoingMessageAdmin
+from smssync.backends import get_backend
+from smssync.backends.memory import MemoryBackend
+from smssync.backends.orm import ORMBackend
+from smssync.decorators import get_form_fields
+from smssync.devices import HashRouter, get_router
+from smssync.handlers import Dispatcher, Handler, receive_handlers
+from smssync.keywords import KeywordRouter
+from smssync.logs import MessageLogger
+from smssync.managers import status_in
+from smssync.metrics import get_metrics
+from smssync.notify import Notifier
+from smssync.numbers import (cache_info, clear_cache, format_number,
+                             parse_number)
+from smssync.ratelimit import RateLimiter, TokenBucket
+from smssync.views import StreamingJsonResponse, SyncView, metrics
+from smssync.models import (ArchivedIncomingMessage, ArchivedOutgoingMessage,
+                            IncomingMessage, OutgoingMessage)
+
 
-from smssync.views import SyncView
-from smssync.models import IncomingMessage, OutgoingMessage
+class SMSSyncAssertions(object):
 
+    def get_post_params(self, **kwargs):
+        """The fields SMSSync posts for a message, updated with ``kwargs``"""
+        params = {'from': "+000-000-0000",
+                  'message': "sample text",
+                  'secret': settings.SMSSYNC_SECRET_KEY,
+                  'device_id': "1",
+                  'sent_timestamp': "1298244863000",
+                  'message_id': "6b5232ad-2bb3-4d94-8dcb-3a50ffbcadc9"}
+        params.update(kwargs)
+        return params
 
-class SMSSyncBaseTest(TestCase):
+    def json(self, response):
+        if not response.streaming:
+            return response.json()
+        # streaming content can only be consumed once
+        if not hasattr(response, 'streamed_json'):
+            content = b''.join(response.streaming_content)
+            response.streamed_json = json.loads(content.decode())
+        return response.streamed_json
 
     def assertPayloadSuccess(self, response):
-        assert response.json()['payload']['success']
-        self.assertIsNone(response.json()['payload']['error'])
+        assert self.json(response)['payload']['success']
+        self.assertIsNone(self.json(response)['payload']['error'])
 
     def assertPayloadFail(self, response, error=None):
-        assert not response.json()['payload']['success']
+        assert not self.json(response)['payload']['success']
         self.assertPayloadError(response, error)
 
     def assertPayloadError(self, response, error=None):
-        payload = response.json()['payload']['error']
+        payload = self.json(response)['payload']['error']
         assert len(payload)
         if error:
             msg = "Error msg wasn't {}: {}".format(payload, error)
             self.assertEqual(payload, error, msg=msg)
 
     def assertPayloadSecret(self, response, secret):
-        payload = response.json()['payload']['secret']
+        payload = self.json(response)['payload']['secret']
         msg = "Secret wasn't {}: {}".format(payload, secret)
         self.assertEqual(payload, secret, msg=msg)
 
     def assertPayloadMessageCount(self, response, count):
-        payload = response.json()['payload']['messages']
+        payload = self.json(response)['payload']['messages']
         msg = "Message count wasn't {}: {}".format(len(payload), count)
         self.assertEqual(len(payload), count, msg=msg)
 
     def assertPayloadTask(self, response, task):
-        payload = response.json()['payload']['task']
+        payload = self.json(response)['payload']['task']
         msg = "Task wasn't {}: {}".format(payload, task)
         self.assertEqual(payload, task, msg=msg)
 
@@ -82,7 +141,7 @@ class SMSSyncBaseTest(TestCase):
         self.assertEqual(count, db_count, msg=msg)
 
     def assertUnsentOutgoingMessageCount(self, count):
-        db_count = OutgoingMessage.objects.filter(sent=False).count()
+        db_count = OutgoingMessage.objects.outgoing().count()
         msg = "Unsent message count wasn't %d: %d" % (count, db_count)
         self.assertEqual(count, db_count, msg=msg)
 
@@ -104,22 +163,93 @@ class SMSSyncBaseTest(TestCase):
         self.assertStatusCode(503, response)
 
 
+class SMSSyncBaseTest(SMSSyncAssertions, TestCase):
+    pass
+
+
 class ModelTests(SMSSyncBaseTest):
 
     def test_mark_as_sent(self):
         m0 = mommy.make(OutgoingMessage, to="+000-000-000")
-        assert not m0.sent
-        m0.mark_as_sent()
-        assert m0.sent
-        from django.utils import timezone
+        assert m0.mark_as_sent()
+        self.assertEqual(m0.status, OutgoingMessage.SENT)
+        m0.refresh_from_db()
+        self.assertEqual(m0.status, OutgoingMessage.SENT)
         assert m0.sent_timestamp < timezone.now()
 
+    def test_queryset_mark_as_sent(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=3)
+        self.assertUnsentOutgoingMessageCount(3)
+        with self.assertNumQueries(1):
+            updated = OutgoingMessage.objects.outgoing().mark_as_sent()
+        self.assertEqual(updated, 3)
+        self.assertUnsentOutgoingMessageCount(0)
+        self.assertFalse(OutgoingMessage.objects.filter(
+            sent_timestamp__isnull=True).exists())
+
+    def test_claim(self):
+        messages = [mommy.make(OutgoingMessage, to="+000-000-000")
+                    for i in range(5)]
+        first = OutgoingMessage.objects.claim(2).order_by('created')
+        self.assertEqual([m.id for m in first],
+                         [m.id for m in messages[:2]])
+        assert all(m.status == OutgoingMessage.CLAIMED for m in first)
+        second = OutgoingMessage.objects.claim()
+        self.assertEqual(set(m.id for m in second),
+                         set(m.id for m in messages[2:]))
+        self.assertUnsentOutgoingMessageCount(0)
+        self.assertEqual(OutgoingMessage.objects.claim().count(), 0)
+
+    def test_claim_update_has_no_limit(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(OutgoingMessage.objects.claim(2).count(), 2)
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        # MySQL rejects LIMIT in a subquery of the updated table
+        self.assertNotIn('LIMIT', updates[0])
+
+    def test_claim_skips_sent(self):
+        m0 = mommy.make(OutgoingMessage, to="+000-000-000",
+                        status=OutgoingMessage.SENT)
+        m1 = mommy.make(OutgoingMessage, to="+000-000-000")
+        self.assertEqual([m.id for m in OutgoingMessage.objects.claim()],
+                         [m1.id])
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite query plans")
+    def test_queue_scans_use_indexes(self):
+        plans = [(OutgoingMessage.objects.outgoing().for_device(""),
+                  'smssync_out_queue_idx'),
+                 (OutgoingMessage.objects.outgoing().for_device("1"),
+                  'smssync_out_queue_idx'),
+                 (IncomingMessage.objects.incoming(),
+                  'smssync_in_pending_idx'),
+                 (IncomingMessage.objects.incoming().sent_from("+000-000-000"),
+                  'smssync_in_sender_idx')]
+        for qs, index in plans:
+            plan = qs[:10].explain()
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_create_duplicate(self):
+        params = {'from': "+000-000-0000",
+                  'message': "sample text",
+                  'sent_timestamp': "1298244863000",
+                  'message_id': "6b5232ad-2bb3-4d94-8dcb-3a50ffbcadc9"}
+        backend = ORMBackend()
+        new = [IncomingMessage.build(**params) for i in range(2)]
+        # only the first copy is new
+        self.assertEqual(backend.store(new), new[:1])
+        self.assertEqual(backend.store([IncomingMessage.build(**params)]), [])
+        self.assertIncomingMessageCount(1)
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, IncomingMessage.create, **params)
+
     def test_mark_as_received(self):
         m0 = mommy.make(IncomingMessage, sent_from="+000-000-000")
         assert not m0.received
         m0.mark_as_received()
         assert m0.received
-        from django.utils import timezone
         assert m0.received_timestamp < timezone.now()
 
     def test_incoming_from_filter(self):
@@ -136,11 +266,37 @@ class ModelTests(SMSSyncBaseTest):
 
 
     def test_outgoing_filter(self):
-        m0 = mommy.make(OutgoingMessage, to="+000-000-000", sent=True)
-        m1 = mommy.make(OutgoingMessage, to="+000-000-001", sent=False)
+        m0 = mommy.make(OutgoingMessage, to="+000-000-000",
+                        status=OutgoingMessage.SENT)
+        m1 = mommy.make(OutgoingMessage, to="+000-000-001",
+                        status=OutgoingMessage.QUEUED)
         self.assertOutgoingMessageCount(2)
         self.assertUnsentOutgoingMessageCount(1)
 
+    def test_transitions(self):
+        m0 = mommy.make(OutgoingMessage, to="+000-000-000")
+        assert not m0.transition(OutgoingMessage.DELIVERED)
+        self.assertEqual(m0.status, OutgoingMessage.QUEUED)
+        assert m0.transition(OutgoingMessage.CLAIMED)
+        assert m0.claimed_timestamp and m0.status_timestamp
+        assert m0.transition(OutgoingMessage.FAILED)
+        for status in (OutgoingMessage.SENT, OutgoingMessage.DELIVERED,
+                       OutgoingMessage.EXPIRED):
+            assert not m0.transition(status)
+        m0.refresh_from_db()
+        self.assertEqual(m0.status, OutgoingMessage.FAILED)
+
+    def test_queryset_transition_query_count(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=3)
+        mommy.make(OutgoingMessage, to="+000-000-000",
+                   status=OutgoingMessage.DELIVERED)
+        with self.assertNumQueries(1):
+            moved = OutgoingMessage.objects.all().transition(
+                OutgoingMessage.EXPIRED)
+        self.assertEqual(moved, 3)
+        self.assertEqual(OutgoingMessage.objects.filter(
+            status=OutgoingMessage.EXPIRED).count(), 3)
+
 
 class SyncViewTests(SMSSyncBaseTest):
     def setUp(self):
@@ -148,12 +304,7 @@ class SyncViewTests(SMSSyncBaseTest):
         self.factory = RequestFactory()
         self.client = Client()
         self.secret = settings.SMSSYNC_SECRET_KEY
-        self.post_params = {'from': "+000-000-0000",
-                            'message': "sample text",
-                            'secret': self.secret,
-                            'device_id': "1",
-                            'sent_timestamp': "1298244863000",
-                            'message_id': "6b5232ad-2bb3-4d94-8dcb-3a50ffbcadc9"}
+        self.post_params = self.get_post_params()
 
     def test_post_message(self):
         """
@@ -174,6 +325,20 @@ class SyncViewTests(SMSSyncBaseTest):
         self.assertIncomingMessageCount(1)
         self.assertIncomingMessageExists("6b5232ad-2bb3-4d94-8dcb-3a50ffbcadc9")
 
+    def test_post_message_again(self):
+        """
+        SMSSync posts a message again when it didn't get the response
+        """
+        response = self.client.post(self.url, self.post_params)
+        self.assertPayloadSuccess(response)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, self.post_params)
+        self.assert200(response)
+        self.assertPayloadSuccess(response)
+        self.assertEqual(len([q for q in queries
+                              if 'smssync_' in q['sql']]), 1)
+        self.assertIncomingMessageCount(1)
+
     def test_post_message_missing_required_fields(self):
         for field in IncomingMessage.REQUIRED_KEYWORDS:
             _params = self.post_params.copy()
@@ -191,7 +356,8 @@ class SyncViewTests(SMSSyncBaseTest):
         _params['message_id'] = "80"
         response = self.client.post(self.url, _params)
         self.assert200(response)
-        expected_error_msg = "badly formed hexadecimal UUID string"
+        expected_error_msg = (IncomingMessage._meta.pk
+                              .error_messages['invalid'] % {'value': "80"})
         self.assertPayloadFail(response, expected_error_msg)
 
     def test_post_message_bad_secret(self):
@@ -206,6 +372,88 @@ class SyncViewTests(SMSSyncBaseTest):
                               "not match the one on the server")
         self.assertPayloadFail(response, expected_error_msg)
 
+    def post_batch(self, items, secret=None):
+        url = "{}?task=batch&secret={}".format(self.url, secret or self.secret)
+        return self.client.post(url, json.dumps(items),
+                                content_type="application/json")
+
+    def test_post_batch(self):
+        ids = ["6b5232ad-2bb3-4d94-8dcb-3a50ffbcad{:02d}".format(i)
+               for i in range(3)]
+        items = [dict(self.post_params, message_id=id) for id in ids]
+        for item in items:
+            del item['secret']
+        items[1]['sent_timestamp'] = 1298244863000
+        bad = dict(items[0], message_id="80")
+        missing = dict(items[0], message="")
+        response = self.post_batch(items + [bad, missing, "junk"])
+        self.assert200(response)
+        self.assertPayloadSuccess(response)
+        results = self.json(response)['payload']['messages']
+        self.assertEqual([r['success'] for r in results],
+                         [True, True, True, False, False, False])
+        self.assertEqual([r['message_id'] for r in results[:5]],
+                         ids + ["80", ids[0]])
+        self.assertEqual(results[4]['error'],
+                         "Required keyword(s) missing: message")
+        self.assertIncomingMessageCount(3)
+        for id in ids:
+            self.assertIncomingMessageExists(id)
+
+    def test_post_batch_too_long(self):
+        ids = ["6b5232ad-2bb3-4d94-8dcb-3a50ffbcad{:02d}".format(i)
+               for i in range(3)]
+        items = [dict(self.post_params, message_id=id) for id in ids]
+        items[1]['message'] = "x" * 161
+        response = self.post_batch(items)
+        self.assert200(response)
+        self.assertPayloadSuccess(response)
+        results = self.json(response)['payload']['messages']
+        self.assertEqual([r['success'] for r in results], [True, False, True])
+        self.assertIn("160 characters", results[1]['error'])
+        self.assertIncomingMessageCount(2)
+        self.assertIncomingMessageExists(ids[0])
+        self.assertIncomingMessageExists(ids[2])
+
+    def test_post_batch_bad_timestamp(self):
+        items = [dict(self.post_params, sent_timestamp=timestamp,
+                      message_id=str(uuid.uuid4()))
+                 for timestamp in ("1e20", "inf", "nan", "1298244863000")]
+        response = self.post_batch(items)
+        self.assert200(response)
+        results = self.json(response)['payload']['messages']
+        self.assertEqual([r['success'] for r in results],
+                         [False, False, False, True])
+        self.assertEqual(results[0]['error'], "Invalid sent_timestamp: 1e20")
+        self.assertIncomingMessageCount(1)
+
+    def test_post_batch_again(self):
+        items = [self.post_params]
+        self.assertPayloadSuccess(self.post_batch(items))
+        response = self.post_batch(items)
+        self.assertPayloadSuccess(response)
+        results = self.json(response)['payload']['messages']
+        self.assertTrue(results[0]['success'])
+        self.assertIncomingMessageCount(1)
+
+    def test_post_batch_bad_body(self):
+        response = self.post_batch({'not': "a list"})
+        self.assert200(response)
+        self.assertPayloadFail(response)
+        self.assertIncomingMessageCount(0)
+
+    def test_post_batch_bad_secret(self):
+        response = self.post_batch([self.post_params], secret="42")
+        self.assert403(response)
+        self.assertIncomingMessageCount(0)
+
+    def test_get_unknown_task(self):
+        for task in ("nope", ""):
+            response = self.client.get(self.url, {'task': task,
+                                                  'secret': self.secret})
+            self.assert200(response)
+            self.assertPayloadFail(response, "Unknown task: {}".format(task))
+
     def test_get_task(self):
         m0 = mommy.make(OutgoingMessage, to="+000-000-000")
         m1 = mommy.make(OutgoingMessage, to="+000-000-000")
@@ -226,6 +474,1029 @@ class SyncViewTests(SMSSyncBaseTest):
         self.assertUnsentOutgoingMessageCount(0)
         self.assertOutgoingMessageCount(3)
 
+    def test_get_task_payload(self):
+        m0 = mommy.make(OutgoingMessage, to="+000-000-000", message="hi")
+        get_params = {'task': "send",
+                      'secret': self.secret}
+        response = self.client.get(self.url, get_params)
+        self.assertEqual(self.json(response)['payload']['messages'],
+                         [{'to': "+000-000-000",
+                           'message': "hi",
+                           'uuid': str(m0.id)}])
+
+    def test_get_task_query_count(self):
+        """
+        The number of queries of a send task must not depend on the number
+        of messages being sent
+        """
+        get_params = {'task': "send",
+                      'secret': self.secret}
+        counts = []
+        for quantity in (1, 20):
+            mommy.make(OutgoingMessage, to="+000-000-000", _quantity=quantity)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url, get_params)
+            self.assertPayloadMessageCount(response, quantity)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(SMSSYNC_SEND_BATCH_SIZE=2,
+                       SMSSYNC_DEVICE_SEND_BATCH_SIZE={'slow': 1})
+    def test_get_task_batch_size(self):
+        messages = [mommy.make(OutgoingMessage, to="+000-000-000")
+                    for i in range(5)]
+        get_params = {'task': "send",
+                      'secret': self.secret}
+        response = self.client.get(self.url, get_params)
+        self.assertPayloadMessageCount(response, 2)
+        self.assertEqual([m['uuid'] for m in
+                          self.json(response)['payload']['messages']],
+                         [str(m.id) for m in messages[:2]])
+        self.assertUnsentOutgoingMessageCount(3)
+        response = self.client.get(self.url, dict(get_params,
+                                                  device_id='slow'))
+        self.assertPayloadMessageCount(response, 1)
+        self.assertEqual(self.json(response)['payload']['messages'][0]['uuid'],
+                         str(messages[2].id))
+        self.assertUnsentOutgoingMessageCount(2)
+
+    def test_streaming_json_response_chunks(self):
+        data = {'payload': {'messages': ["x" * 10] * 100}}
+        response = StreamingJsonResponse(data, chunk_size=100)
+        chunks = list(response.streaming_content)
+        assert len(chunks) > 1
+        self.assertEqual(json.loads(b''.join(chunks).decode()), data)
+
+
+class SecretTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        self.url = reverse_lazy("sync_url")
+        self.post_params = self.get_post_params()
+
+    def post_form(self, params):
+        return self.client.post(self.url, urlencode(params),
+                                content_type=
+                                "application/x-www-form-urlencoded")
+
+    def test_form_post(self):
+        response = self.post_form(self.post_params)
+        self.assertPayloadSuccess(response)
+        self.assertIncomingMessageCount(1)
+
+    def test_rejection_skips_form_parsing(self):
+        with mock.patch.object(HttpRequest, '_load_post_and_files',
+                               side_effect=AssertionError) as load:
+            response = self.post_form(dict(self.post_params, secret="42"))
+        self.assert403(response)
+        load.assert_not_called()
+
+    def test_get_form_fields(self):
+        body = b"message=a%26b&secret=s%C3%A9cret+key&secretive=no"
+        self.assertEqual(get_form_fields(body, ('secret', 'device_id')),
+                         {'secret': "s\xe9cret key"})
+
+    @override_settings(SMSSYNC_DEVICE_SECRETS={"1": "one"})
+    def test_device_secrets(self):
+        self.assert403(self.post_form(self.post_params))
+        response = self.post_form(dict(self.post_params, secret="one"))
+        self.assertPayloadSuccess(response)
+        # other devices still use SMSSYNC_SECRET_KEY
+        response = self.post_form(dict(self.post_params, device_id="2",
+                                       message_id="6b5232ad-2bb3-4d94-8dcb-"
+                                                  "3a50ffbcadca"))
+        self.assertPayloadSuccess(response)
+        response = self.client.get(self.url, {'task': "send",
+                                              'secret': "one",
+                                              'device_id': "1"})
+        self.assertPayloadSecret(response, "one")
+
+    def test_secret_read_at_request_time(self):
+        with override_settings(SMSSYNC_SECRET_KEY="changed"):
+            self.assert403(self.post_form(self.post_params))
+            response = self.post_form(dict(self.post_params,
+                                           secret="changed"))
+            self.assertPayloadSuccess(response)
+
+    def test_constant_time_compare(self):
+        with mock.patch('smssync.devices.hmac.compare_digest',
+                        wraps=hmac.compare_digest) as compare:
+            self.assert403(self.post_form(dict(self.post_params,
+                                               secret="42")))
+        compare.assert_called_once()
+
+    @override_settings(SMSSYNC_SECRET_KEY=None)
+    def test_no_secret(self):
+        params = dict(self.post_params)
+        del params['secret']
+        # a missing secret is a configuration error, not an open endpoint
+        self.assertRaises(ImproperlyConfigured, self.post_form, params)
+        self.assertIncomingMessageCount(0)
+        with self.settings(SMSSYNC_ALLOW_NO_SECRET=True):
+            self.assertPayloadSuccess(self.post_form(params))
+            self.assert403(self.post_form(self.post_params))
+
+    @override_settings(SMSSYNC_DEVICE_SECRETS={"A": "sa", "B": "sb"})
+    def test_duplicate_device_id(self):
+        params = dict(self.post_params, secret="sa", device_id="A")
+        body = urlencode(params) + "&device_id=B"
+        response = self.client.post(self.url, body, content_type=
+                                    "application/x-www-form-urlencoded")
+        self.assert403(response)
+        response = self.client.post(self.url, body + "&secret=sb",
+                                    content_type=
+                                    "application/x-www-form-urlencoded")
+        self.assertPayloadSuccess(response)
+        self.assertEqual(IncomingMessage.objects.get().device_id, "B")
+
+    @override_settings(SMSSYNC_SECRET_KEY=None,
+                       SMSSYNC_DEVICE_SECRETS={"B": "sb"})
+    def test_query_and_body_credentials(self):
+        params = dict(self.post_params, device_id="B")
+        del params['secret']
+        # the body device_id is checked, not the query string secret
+        response = self.client.post("{}?secret=".format(self.url),
+                                    urlencode(params), content_type=
+                                    "application/x-www-form-urlencoded")
+        self.assert403(response)
+        # batches are recorded for the device of the query string
+        batch = [dict(params, device_id="C")]
+        response = self.client.post(
+            "{}?task=batch&secret=sb&device_id=B".format(self.url),
+            json.dumps(batch), content_type="application/json")
+        self.assertPayloadSuccess(response)
+        self.assertEqual(IncomingMessage.objects.get().device_id, "B")
+
+    @override_settings(SMSSYNC_SECRET_KEY=None,
+                       SMSSYNC_DEVICE_SECRETS={"1": "one"})
+    def test_unknown_device_rejected(self):
+        mommy.make(OutgoingMessage, to="+000-000-000")
+        self.assert403(self.client.get(self.url, {'task': "send"}))
+        self.assert403(self.client.get(self.url, {'task': "send",
+                                                  'device_id': "2"}))
+        response = self.client.get(self.url, {'task': "send",
+                                              'secret': "one",
+                                              'device_id': "1"})
+        self.assertPayloadMessageCount(response, 1)
+
+
+class NumberCacheTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        clear_cache()
+        self.addCleanup(clear_cache)
+
+    def test_parse_number_cached(self):
+        first = parse_number("+1 650 253 0000")
+        self.assertIs(parse_number("+1 650 253 0000"), first)
+        self.assertEqual(first.as_e164, "+16502530000")
+        self.assertIsNot(parse_number("650 253 0000", "US"),
+                         parse_number("650 253 0000", "CA"))
+        info = cache_info()['parse']
+        self.assertEqual((info['hits'], info['misses']), (1, 3))
+        self.assertEqual(info['hit_rate'], 0.25)
+        self.assertIsNone(parse_number(None))
+
+    @override_settings(SMSSYNC_NUMBER_CACHE_SIZE=2)
+    def test_cache_is_bounded(self):
+        for i in range(5):
+            parse_number("+1 650 253 000{}".format(i))
+        self.assertEqual(cache_info()['parse']['size'], 2)
+
+    def test_formats_are_memoized(self):
+        number = parse_number("+1 650 253 0000")
+        with mock.patch('phonenumbers.format_number',
+                        wraps=phonenumbers.format_number) as format_number:
+            for i in range(3):
+                str(number)
+        self.assertEqual(format_number.call_count, 1)
+
+    def test_format_number(self):
+        self.assertEqual(format_number("+16502530000"), "+16502530000")
+        with override_settings(PHONENUMBER_DEFAULT_FORMAT="INTERNATIONAL"):
+            self.assertEqual(format_number("+16502530000"), "+1 650-253-0000")
+        with override_settings(SMSSYNC_E164_NUMBERS=True):
+            # stored strings are handed out without parsing them
+            self.assertEqual(format_number("+16502530001"), "+16502530001")
+            self.assertEqual(cache_info()['parse']['misses'], 0)
+
+    def test_task_values_skip_parsing(self):
+        mommy.make(OutgoingMessage, to="+1 650 253 0000")
+        [(id, to, message)] = OutgoingMessage.objects.task_values()
+        self.assertEqual(type(to), str)
+        self.assertEqual(OutgoingMessage.make_task_dict(id, to, message)['to'],
+                         "+16502530000")
+
+
+class ResultsAPITests(SMSSyncBaseTest):
+    def setUp(self):
+        self.url = reverse_lazy("sync_url")
+        self.client = Client()
+        self.secret = settings.SMSSYNC_SECRET_KEY
+        self.messages = mommy.make(OutgoingMessage, to="+000-000-000",
+                                   _quantity=3)
+        OutgoingMessage.objects.claim()
+
+    def post_json(self, task, data):
+        url = "{}?task={}&secret={}".format(self.url, task, self.secret)
+        return self.client.post(url, json.dumps(data),
+                                content_type="application/json")
+
+    def test_sent_task(self):
+        ids = [str(m.id) for m in self.messages[:2]]
+        response = self.post_json(
+            "sent", {"queued_messages": ids + [
+                "4c9e2b5b-0c38-4c29-b8ee-b1f6e9d06a11", "not-a-uuid"]})
+        self.assert200(response)
+        self.assertEqual(sorted(self.json(response)['message_uuids']),
+                         sorted(ids))
+        self.assertEqual(OutgoingMessage.objects.filter(
+            acknowledged_timestamp__isnull=False).count(),
+                         2)
+
+    @override_settings(SMSSYNC_RESULT_BATCH_SIZE=2)
+    def test_get_result_task(self):
+        response = self.client.get(self.url, {'task': "result",
+                                              'secret': self.secret})
+        self.assert200(response)
+        self.assertEqual(len(self.json(response)['message_uuids']), 2)
+
+    @override_settings(SMSSYNC_RESULT_BATCH_SIZE=2)
+    def test_get_result_task_moves_on(self):
+        # sent, but the carrier never reports the delivery
+        self.post_json("result", {"message_result": [
+            {'uuid': str(m.id),
+             'sent_result_code': OutgoingMessage.RESULT_OK,
+             'delivered_result_code': OutgoingMessage.RESULT_NONE}
+            for m in self.messages]})
+        asked = []
+        for i in range(2):
+            response = self.client.get(self.url, {'task': "result",
+                                                  'secret': self.secret})
+            asked.append(self.json(response)['message_uuids'])
+        self.assertEqual(len(asked[0]), 2)
+        self.assertEqual(set(asked[0]) | set(asked[1]),
+                         {str(m.id) for m in self.messages})
+
+    def test_post_result_task(self):
+        m0, m1, m2 = self.messages
+        results = [{'uuid': str(m.id),
+                    'sent_result_code': OutgoingMessage.RESULT_OK,
+                    'sent_result_message': "SMSSync Message Sent",
+                    'delivered_result_code': OutgoingMessage.RESULT_OK,
+                    'delivered_result_message': "SMS Delivered"}
+                   for m in (m0, m1)]
+        results.append({'uuid': str(m2.id),
+                        'sent_result_code': 4,
+                        'sent_result_message': "No service",
+                        'delivered_result_code': 0,
+                        'delivered_result_message': ""})
+        response = self.post_json("result", {"message_result": results})
+        self.assert200(response)
+        self.assertPayloadSuccess(response)
+
+        for m in (m0, m1):
+            m.refresh_from_db()
+            self.assertEqual(m.status, OutgoingMessage.DELIVERED)
+            self.assertEqual(m.sms_delivered_result_message, "SMS Delivered")
+        m2.refresh_from_db()
+        self.assertEqual(m2.status, OutgoingMessage.FAILED)
+        self.assertEqual(m2.sms_sent_result_code, 4)
+        self.assertIsNone(m2.sms_delivered_result_code)
+        self.assertEqual(OutgoingMessage.objects.awaiting_report().count(), 0)
+
+    def test_post_result_task_bad_body(self):
+        response = self.post_json("result", [])
+        self.assert200(response)
+        self.assertPayloadFail(response)
+
+    def test_report_results_query_count(self):
+        """
+        Messages sharing the same result are updated together
+        """
+        results = [{'uuid': str(m.id),
+                    'sent_result_code': OutgoingMessage.RESULT_OK,
+                    'sent_result_message': "SMSSync Message Sent"}
+                   for m in self.messages]
+        with CaptureQueriesContext(connection) as queries:
+            OutgoingMessage.objects.report_results(results)
+        self.assertEqual(len([q for q in queries
+                              if q['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(OutgoingMessage.objects.filter(
+            status=OutgoingMessage.SENT).count(), 3)
+        self.assertEqual(OutgoingMessage.objects.awaiting_report().count(), 3)
+
+
+class RetryTests(SMSSyncBaseTest):
+
+    def claim_ago(self, seconds, **kwargs):
+        message = mommy.make(OutgoingMessage, to="+000-000-000", **kwargs)
+        OutgoingMessage.objects.claim()
+        OutgoingMessage.objects.filter(id=message.id).update(
+            claimed_timestamp=timezone.now() - timedelta(seconds=seconds))
+        return message
+
+    def assertStatus(self, message, status):
+        message.refresh_from_db()
+        self.assertEqual(message.status, status)
+
+    def test_retry_with_backoff(self):
+        m0 = self.claim_ago(90)
+        m1 = self.claim_ago(30)
+        queued, expired = OutgoingMessage.objects.retry(60, 3)
+        self.assertEqual((queued, expired), (1, 0))
+        self.assertStatus(m0, OutgoingMessage.QUEUED)
+        self.assertStatus(m1, OutgoingMessage.CLAIMED)
+
+        # second attempt, the lease is now twice as long
+        self.assertEqual(list(OutgoingMessage.objects.claim()), [m0])
+        OutgoingMessage.objects.filter(id=m0.id).update(
+            claimed_timestamp=m1.created - timedelta(seconds=90))
+        self.assertEqual(OutgoingMessage.objects.retry(60, 3), (0, 0))
+        OutgoingMessage.objects.filter(id=m0.id).update(
+            claimed_timestamp=m1.created - timedelta(seconds=150))
+        self.assertEqual(OutgoingMessage.objects.retry(60, 3), (1, 0))
+        m0.refresh_from_db()
+        self.assertEqual(m0.attempts, 2)
+        self.assertIsNone(m0.claim_token)
+
+    def test_retry_expires_after_max_attempts(self):
+        m0 = self.claim_ago(3600, attempts=2)
+        self.assertEqual(OutgoingMessage.objects.retry(60, 3), (0, 1))
+        self.assertStatus(m0, OutgoingMessage.EXPIRED)
+
+    def test_retry_skips_acknowledged(self):
+        m0 = self.claim_ago(3600)
+        OutgoingMessage.objects.acknowledge([m0.id])
+        m1 = self.claim_ago(3600)
+        m1.transition(OutgoingMessage.SENT)
+        self.assertEqual(OutgoingMessage.objects.retry(60, 3), (0, 0))
+
+    def test_retry_in_batches(self):
+        for i in range(5):
+            self.claim_ago(3600)
+        with CaptureQueriesContext(connection) as queries:
+            queued, expired = OutgoingMessage.objects.retry(60, 2,
+                                                            batch_size=2)
+        self.assertEqual(queued, 5)
+        updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+        # 3 batches of queued messages, none of expired ones
+        self.assertEqual(len(updates), 3)
+        # the ids are read beforehand, MySQL rejects LIMIT in the subquery
+        for update in updates:
+            self.assertNotIn('LIMIT', update['sql'])
+
+    def test_expire(self):
+        m0 = mommy.make(OutgoingMessage, to="+000-000-000")
+        m1 = mommy.make(OutgoingMessage, to="+000-000-000",
+                        status=OutgoingMessage.DELIVERED)
+        OutgoingMessage.objects.update(created=m0.created -
+                                       timedelta(days=2))
+        m2 = mommy.make(OutgoingMessage, to="+000-000-000")
+        self.assertEqual(OutgoingMessage.objects.expire(24 * 3600), 1)
+        self.assertStatus(m0, OutgoingMessage.EXPIRED)
+        self.assertStatus(m1, OutgoingMessage.DELIVERED)
+        self.assertStatus(m2, OutgoingMessage.QUEUED)
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite query plans")
+    def test_scans_use_indexes(self):
+        now = timezone.now()
+        plans = [(OutgoingMessage.objects.unacknowledged().filter(
+                     attempts=1, claimed_timestamp__lt=now),
+                  'smssync_out_lease_idx'),
+                 (OutgoingMessage.objects.filter(
+                     status_in(OutgoingMessage.QUEUED,
+                               OutgoingMessage.CLAIMED),
+                     created__lt=now),
+                  'smssync_out_live_idx')]
+        for qs, index in plans:
+            self.assertIn(index, qs.order_by().values('id')[:10].explain())
+        plan = OutgoingMessage.objects.awaiting_report()[:10].explain()
+        self.assertIn('smssync_out_report_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    @override_settings(SMSSYNC_CLAIM_LEASE=60, SMSSYNC_MAX_ATTEMPTS=1,
+                       SMSSYNC_MESSAGE_TTL=3600)
+    def test_retry_command(self):
+        self.claim_ago(120)
+        out = StringIO()
+        call_command('smssync_retry', stdout=out)
+        self.assertIn("expired 1", out.getvalue())
+
+
+class ArchiveTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        old = timezone.now() - timedelta(days=40)
+        for status in (OutgoingMessage.QUEUED, OutgoingMessage.CLAIMED,
+                       OutgoingMessage.SENT, OutgoingMessage.DELIVERED,
+                       OutgoingMessage.FAILED, OutgoingMessage.EXPIRED):
+            mommy.make(OutgoingMessage, to="+1 650 253 0000", status=status,
+                       _quantity=2)
+        mommy.make(IncomingMessage, sent_from="+1 650 253 0000",
+                   sent_timestamp=old, received=True, _quantity=3)
+        mommy.make(IncomingMessage, sent_from="+1 650 253 0000",
+                   sent_timestamp=old, _quantity=2)
+        OutgoingMessage.objects.update(created=old)
+        IncomingMessage.objects.update(created=old)
+        # recent messages are kept
+        mommy.make(OutgoingMessage, to="+1 650 253 0000",
+                   status=OutgoingMessage.DELIVERED)
+        mommy.make(IncomingMessage, sent_from="+1 650 253 0000",
+                   sent_timestamp=old, received=True)
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('smssync_archive', *args, stdout=out)
+        return out.getvalue()
+
+    def test_archive(self):
+        delivered = OutgoingMessage.objects.filter(
+            status=OutgoingMessage.DELIVERED).earliest('created')
+        output = self.archive('30', '--batch-size', '3')
+        self.assertIn("Archived 10 outgoing messages", output)
+        self.assertIn("Archived 3 incoming messages", output)
+        # pending messages stay in the hot tables
+        self.assertOutgoingMessageCount(3)
+        self.assertEqual(OutgoingMessage.objects.done().count(), 1)
+        # claimed messages may never be reported sent
+        self.assertFalse(OutgoingMessage.objects.claimed().exists())
+        self.assertEqual(ArchivedOutgoingMessage.objects.filter(
+            status=OutgoingMessage.CLAIMED).count(), 2)
+        self.assertIncomingMessageCount(3)
+        self.assertUnreceivedIncomingMessageCount(2)
+        self.assertEqual(ArchivedOutgoingMessage.objects.count(), 10)
+        self.assertEqual(ArchivedIncomingMessage.objects.count(), 3)
+        archived = ArchivedOutgoingMessage.objects.get(id=delivered.id)
+        for field in OutgoingMessage._meta.concrete_fields:
+            self.assertEqual(getattr(archived, field.attname),
+                             getattr(delivered, field.attname))
+        self.assertIn("Archived 0 outgoing messages", self.archive('30'))
+
+    @skipUnless(connection.vendor == 'sqlite', "SQLite query plans")
+    def test_archive_uses_index(self):
+        qs = OutgoingMessage.objects.archivable().filter(
+            created__lt=timezone.now())
+        self.assertIn('smssync_out_dequeued_idx',
+                      qs.order_by().values('pk')[:10].explain())
+
+    def test_archive_again(self):
+        delivered = OutgoingMessage.objects.filter(
+            status=OutgoingMessage.DELIVERED).earliest('created')
+        # left behind by an interrupted run
+        ArchivedOutgoingMessage.objects.create(**{
+            field.attname: getattr(delivered, field.attname)
+            for field in OutgoingMessage._meta.concrete_fields})
+        output = self.archive('30', '--batch-size', '3')
+        self.assertIn("Archived 10 outgoing messages", output)
+        self.assertOutgoingMessageCount(3)
+        self.assertEqual(ArchivedOutgoingMessage.objects.count(), 10)
+        self.assertTrue(ArchivedOutgoingMessage.objects.filter(
+            id=delivered.id).exists())
+
+    def test_purge(self):
+        output = self.archive('30', '--purge')
+        self.assertIn("Deleted 10 outgoing messages", output)
+        self.assertIn("Deleted 3 incoming messages", output)
+        self.assertOutgoingMessageCount(3)
+        self.assertIncomingMessageCount(3)
+        self.assertFalse(ArchivedOutgoingMessage.objects.exists())
+
+    def test_purge_archive(self):
+        self.archive('30')
+        output = self.archive('30', '--purge-archive', '50')
+        self.assertIn("Deleted 0 archived outgoing messages", output)
+        output = self.archive('30', '--purge-archive', '35')
+        self.assertIn("Deleted 10 archived outgoing messages", output)
+        self.assertIn("Deleted 3 archived incoming messages", output)
+        self.assertFalse(ArchivedOutgoingMessage.objects.exists())
+
+
+class AdminTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        user = User.objects.create_superuser("admin", "admin@example.com",
+                                             "admin")
+        self.client.force_login(user)
+        self.url = reverse_lazy("admin:smssync_outgoingmessage_changelist")
+
+    def test_keyset_pagination(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=5)
+        seen = []
+        url = self.url
+        with mock.patch.object(OutgoingMessageAdmin, 'list_per_page', 2):
+            while url:
+                response = self.client.get(url)
+                self.assert200(response)
+                cl = response.context['cl']
+                self.assertEqual(cl.result_count, 5)
+                seen.extend(m.pk for m in cl.result_list)
+                url = cl.next_url and str(self.url) + cl.next_url
+        expected = OutgoingMessage.objects.order_by('-created', '-pk')
+        self.assertEqual(seen, list(expected.values_list('pk', flat=True)))
+        # only the displayed columns are read
+        self.assertEqual(cl.result_list[0].get_deferred_fields(),
+                         {'status_timestamp', 'claimed_timestamp',
+                          'sent_timestamp', 'claim_token',
+                          'acknowledged_timestamp',
+                          'sms_sent_result_code', 'sms_sent_result_message',
+                          'sms_sent_report_timestamp',
+                          'sms_delivered_result_code',
+                          'sms_delivered_result_message',
+                          'sms_delivered_report_timestamp',
+                          'report_requested_timestamp'})
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url, {'after': "nope"})
+        self.assertStatusCode(302, response)
+
+    def test_estimated_count(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=5)
+        with mock.patch.object(EstimatedCountPaginator, 'MAX_COUNT', 3):
+            paginator = EstimatedCountPaginator(
+                OutgoingMessage.objects.all(), 2)
+            if connection.vendor == 'sqlite':
+                # no statistics yet, the count stops at MAX_COUNT
+                self.assertEqual(paginator.count, 3)
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+            paginator = EstimatedCountPaginator(
+                OutgoingMessage.objects.all(), 2)
+            self.assertEqual(paginator.count, 5)
+            paginator = EstimatedCountPaginator(
+                OutgoingMessage.objects.outgoing(), 2)
+            self.assertEqual(paginator.count, 3)
+
+    def test_search_by_number(self):
+        url = reverse_lazy("admin:smssync_incomingmessage_changelist")
+        mommy.make(IncomingMessage, sent_from="+16502530000")
+        mommy.make(IncomingMessage, sent_from="+16502530001")
+        response = self.client.get(url, {'q': "+1 650 253 0000"})
+        self.assertEqual([str(m.sent_from) for m in
+                          response.context['cl'].result_list],
+                         ["+16502530000"])
+
+    def test_actions(self):
+        claimed = mommy.make(OutgoingMessage, to="+000-000-000",
+                             status=OutgoingMessage.CLAIMED, _quantity=2)
+        failed = mommy.make(OutgoingMessage, to="+000-000-000",
+                            status=OutgoingMessage.FAILED, attempts=5)
+        delivered = mommy.make(OutgoingMessage, to="+000-000-000",
+                               status=OutgoingMessage.DELIVERED)
+        selected = [m.pk for m in claimed + [failed, delivered]]
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(self.url, {'action': "requeue",
+                                        '_selected_action': selected})
+        self.assertEqual(len([q for q in queries
+                              if q['sql'].startswith('UPDATE "smssync_')]),
+                         1)
+        self.assertUnsentOutgoingMessageCount(2)
+        self.client.post(self.url, {'action': "resend",
+                                    '_selected_action': selected})
+        self.assertUnsentOutgoingMessageCount(3)
+        failed.refresh_from_db()
+        self.assertEqual(failed.attempts, 0)
+        self.client.post(self.url, {'action': "expire",
+                                    '_selected_action': selected})
+        self.assertEqual(OutgoingMessage.objects.filter(
+            status=OutgoingMessage.EXPIRED).count(), 3)
+        delivered.refresh_from_db()
+        self.assertEqual(delivered.status, OutgoingMessage.DELIVERED)
+
+
+class AsyncSyncViewTests(SMSSyncAssertions, TransactionTestCase):
+    """
+    The async view runs its database work in other threads, which can only
+    see committed data
+    """
+    def setUp(self):
+        self.url = reverse_lazy("async_sync_url")
+        self.secret = settings.SMSSYNC_SECRET_KEY
+        self.post_params = self.get_post_params()
+
+    async def test_post_message(self):
+        response = await self.async_client.post(self.url, self.post_params)
+        self.assert200(response)
+        self.assertPayloadSuccess(response)
+        exists = IncomingMessage.objects.filter(
+            id=self.post_params['message_id']).aexists()
+        self.assertTrue(await exists)
+
+    async def test_post_message_bad_secret(self):
+        _params = dict(self.post_params, secret="42")
+        response = await self.async_client.post(self.url, _params)
+        self.assert403(response)
+        self.assertPayloadFail(response)
+        self.assertEqual(await IncomingMessage.objects.acount(), 0)
+
+    async def test_get_task(self):
+        await OutgoingMessage.objects.acreate(to="+000-000-000")
+        await OutgoingMessage.objects.acreate(to="+000-000-000")
+        get_params = {'task': "send",
+                      'secret': self.secret}
+        response = await self.async_client.get(self.url, get_params)
+        self.assert200(response)
+        # not a streaming response, which ASGIHandler would buffer in a
+        # thread
+        self.assertFalse(response.streaming)
+        self.assertPayloadMessageCount(response, 2)
+        unsent = OutgoingMessage.objects.outgoing().acount()
+        self.assertEqual(await unsent, 0)
+
+
+class DeviceRoutingTests(SMSSyncBaseTest):
+
+    def test_claim_device_queue_first(self):
+        shared = mommy.make(OutgoingMessage, to="+000-000-000")
+        mine = mommy.make(OutgoingMessage, to="+000-000-000", device_id="1")
+        other = mommy.make(OutgoingMessage, to="+000-000-000", device_id="2")
+        claimed = OutgoingMessage.objects.claim(1, device_id="1")
+        self.assertEqual([m.id for m in claimed], [mine.id])
+        claimed = OutgoingMessage.objects.claim(device_id="1")
+        self.assertEqual([m.id for m in claimed], [shared.id])
+        self.assertEqual(OutgoingMessage.objects.claim().count(), 0)
+        self.assertEqual([m.id for m in OutgoingMessage.objects.claim(
+            device_id="2")], [other.id])
+
+    def test_pending_counts(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", device_id="1",
+                   _quantity=2)
+        mommy.make(OutgoingMessage, to="+000-000-000", device_id="2",
+                   status=OutgoingMessage.CLAIMED)
+        self.assertEqual(OutgoingMessage.objects.pending_counts(["1", "2"]),
+                         {"1": 2, "2": 0})
+
+    def test_hash_router(self):
+        numbers = ["+000-000-{:03d}".format(i) for i in range(200)]
+        before = HashRouter(["1", "2", "3"])
+        after = HashRouter(["1", "2", "3", "4"])
+        devices = [before.device_for(n) for n in numbers]
+        self.assertEqual(set(devices), {"1", "2", "3"})
+        self.assertEqual(devices, [before.device_for(n) for n in numbers])
+        moved = [n for n in numbers
+                 if before.device_for(n) != after.device_for(n)]
+        self.assertEqual(set(after.device_for(n) for n in moved), {"4"})
+
+    @override_settings(SMSSYNC_ROUTER='smssync.devices.LeastLoadedRouter',
+                       SMSSYNC_DEVICES=["1", "2"])
+    def test_least_loaded_router(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", device_id="1",
+                   _quantity=2)
+        smssync.send_many([("Hello", "+000-000-000")] * 4)
+        self.assertEqual(OutgoingMessage.objects.pending_counts(["1", "2"]),
+                         {"1": 3, "2": 3})
+        om = smssync.send("Hello", "+000-000-000", device_id="2")
+        self.assertEqual(om.device_id, "2")
+
+    @override_settings(SMSSYNC_ROUTER='smssync.devices.HashRouter',
+                       SMSSYNC_DEVICES=["1", "2"])
+    def test_get_task_device(self):
+        smssync.send_many(("Hello", "+000-000-{:03d}".format(i))
+                          for i in range(10))
+        get_params = {'task': "send",
+                      'secret': settings.SMSSYNC_SECRET_KEY,
+                      'device_id': "1"}
+        response = self.client.get(reverse_lazy("sync_url"), get_params)
+        messages = self.json(response)['payload']['messages']
+        assert messages
+        for m in messages:
+            self.assertEqual(get_router().device_for(m['to']), "1")
+        self.assertUnsentOutgoingMessageCount(10 - len(messages))
+
+
+class RateLimitTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        cache.clear()
+        self.get_params = {'task': "send",
+                           'secret': settings.SMSSYNC_SECRET_KEY,
+                           'device_id': "1"}
+
+    def test_token_bucket(self):
+        bucket = TokenBucket('key', 10, 60)
+        self.assertEqual(bucket.tokens(None, 1000), 10)
+        self.assertEqual(bucket.tokens((4, 1000), 1006), 5)
+        self.assertEqual(bucket.tokens((4, 1000), 2000), 10)
+
+    @override_settings(SMSSYNC_RATE_LIMIT_PER_MINUTE=3,
+                       SMSSYNC_RATE_LIMIT_PER_HOUR=5)
+    def test_get_task_rate_limit(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=10)
+        url = reverse_lazy("sync_url")
+        response = self.client.get(url, self.get_params)
+        self.assertPayloadMessageCount(response, 3)
+        response = self.client.get(url, self.get_params)
+        self.assertPayloadMessageCount(response, 0)
+        # other devices have their own limits
+        response = self.client.get(url, dict(self.get_params,
+                                              device_id="2"))
+        self.assertPayloadMessageCount(response, 3)
+        self.assertUnsentOutgoingMessageCount(4)
+        # a minute later the hourly limit kicks in
+        with mock.patch('time.time', return_value=time.time() + 60):
+            self.assertEqual(RateLimiter().allowance("1"), 2)
+            response = self.client.get(url, self.get_params)
+        self.assertPayloadMessageCount(response, 2)
+
+    def test_no_rate_limit(self):
+        self.assertIsNone(RateLimiter().allowance("1"))
+
+
+class LoggingTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        self.url = reverse_lazy("sync_url")
+        self.post_params = self.get_post_params()
+
+    def test_secret_redacted(self):
+        with self.assertLogs('smssync.views', 'INFO') as logs:
+            self.client.post(self.url, self.post_params)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("'secret': '********'", logs.output[0])
+        self.assertNotIn(settings.SMSSYNC_SECRET_KEY, logs.output[0])
+        self.assertIn("'message': 'sample text'", logs.output[0])
+        self.assertEqual(logs.records[0].args[0].as_dict()['device_id'], "1")
+
+    def test_sending_messages(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=3)
+        with self.assertLogs('smssync.views', 'INFO') as logs:
+            self.client.get(self.url, {'task': "send",
+                                       'secret': settings.SMSSYNC_SECRET_KEY})
+        self.assertEqual(len(logs.records), 3)
+        self.assertTrue(all(o.startswith("INFO:smssync.views:Sending message")
+                            for o in logs.output))
+
+    @override_settings(SMSSYNC_LOG_SAMPLE_RATE=0.5)
+    def test_sampling(self):
+        message_logger = MessageLogger(logging.getLogger('smssync.views'))
+        with self.assertLogs('smssync.views', 'INFO') as logs, \
+                mock.patch('random.random', side_effect=[0.2, 0.7, 0.4]):
+            message_logger.log("Message: %r", [{'a': 1}, {'b': 2}, {'c': 3}])
+        self.assertEqual([r.args[0].fields for r in logs.records],
+                         [{'a': 1}, {'c': 3}])
+
+    def test_disabled(self):
+        message_logger = MessageLogger(logging.getLogger('smssync.views'),
+                                       logging.DEBUG)
+        with mock.patch('smssync.logs.Redacted') as redacted:
+            message_logger.log("Message: %r", [{'a': 1}])
+        redacted.assert_not_called()
+
+
+@override_settings(SMSSYNC_METRICS='smssync.metrics.PrometheusMetrics')
+class MetricsTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        get_metrics.cache_clear()
+        self.url = reverse_lazy("sync_url")
+        self.post_params = self.get_post_params()
+        self.get_params = {'task': "send",
+                           'secret': settings.SMSSYNC_SECRET_KEY,
+                           'device_id': "1"}
+
+    def render(self):
+        response = metrics(RequestFactory().get('/metrics'))
+        self.assert200(response)
+        return response.content.decode()
+
+    def test_prometheus(self):
+        mommy.make(OutgoingMessage, to="+000-000-000", _quantity=3)
+        self.client.post(self.url, self.post_params)
+        self.client.post(self.url, dict(self.post_params, message_id="x"))
+        self.client.get(self.url, dict(self.get_params, device_id='"2"'))
+        mommy.make(IncomingMessage, sent_from="+000-000-000")
+        text = self.render()
+        self.assertIn('smssync_messages_received_total{device_id="1"} 1\n',
+                      text)
+        self.assertIn('smssync_messages_rejected_total{device_id="1"} 1\n',
+                      text)
+        self.assertIn('smssync_polls_total{device_id="\\"2\\""} 1\n', text)
+        self.assertIn('smssync_messages_sent_total{device_id="\\"2\\""} 3\n',
+                      text)
+        self.assertIn('# TYPE smssync_send_task_seconds summary\n', text)
+        self.assertIn('smssync_get_message_seconds_count 2\n', text)
+        self.assertIn('smssync_get_outgoing_messages_seconds_count 1\n',
+                      text)
+        self.assertIn('smssync_queue_depth{queue="incoming"} 2\n', text)
+        self.assertIn('smssync_queue_depth{queue="outgoing"} 0\n', text)
+        self.assertIn('smssync_number_cache_size{cache="parse"}', text)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        with override_settings(
+                SMSSYNC_METRICS='smssync.metrics.StatsdMetrics',
+                SMSSYNC_STATSD_ADDRESS=server.getsockname()):
+            self.client.get(self.url, self.get_params)
+            get_metrics().gauge('queue_depth', 4, {'queue': "outgoing"})
+        datagrams = [server.recv(512) for i in range(3)]
+        self.assertRegex(datagrams[0], br'^smssync\.get_outgoing_messages:'
+                                       br'[0-9.]+\|ms$')
+        self.assertEqual(datagrams[1], b'smssync.polls.1:1|c')
+        self.assertRegex(datagrams[2], br'^smssync\.send_task:[0-9.]+\|ms$')
+        self.assertEqual(server.recv(512), b'smssync.queue_depth.outgoing:4|g')
+
+    def test_disabled(self):
+        with override_settings(SMSSYNC_METRICS=None):
+            self.assertIsNone(get_metrics())
+            response = self.client.post(self.url, self.post_params)
+            self.assertPayloadSuccess(response)
+            with self.assertRaises(Http404):
+                metrics(RequestFactory().get('/metrics'))
+        self.assertNotIn('messages_received', self.render())
+
+
+class NotifierTests(TestCase):
+
+    def test_wait(self):
+        notifier = Notifier()
+        since = notifier.version
+        self.assertFalse(notifier.wait(0.01, since))
+        threading.Timer(0.05, notifier.notify).start()
+        self.assertTrue(notifier.wait(5, since))
+
+    def test_wait_missed_notification(self):
+        notifier = Notifier()
+        since = notifier.version
+        notifier.notify()
+        self.assertTrue(notifier.wait(0, since))
+
+    async def test_async_wait(self):
+        notifier = Notifier()
+        since = notifier.version
+        self.assertFalse(await notifier.async_wait(0.01, since))
+        threading.Timer(0.05, notifier.notify).start()
+        self.assertTrue(await notifier.async_wait(5, since))
+
+
+@override_settings(SMSSYNC_LONG_POLL_TIMEOUT=5)
+class LongPollTests(SMSSyncAssertions, TransactionTestCase):
+
+    def setUp(self):
+        self.get_params = {'task': "send",
+                           'secret': settings.SMSSYNC_SECRET_KEY}
+
+    def send_later(self):
+        def send():
+            smssync.send("Hello", "+000-000-000")
+            connection.close()
+        threading.Timer(0.1, send).start()
+
+    def test_get_task_waits(self):
+        self.send_later()
+        start = time.monotonic()
+        response = self.client.get(reverse_lazy("sync_url"), self.get_params)
+        self.assertPayloadMessageCount(response, 1)
+        self.assertLess(time.monotonic() - start, 5)
+
+    async def test_async_get_task_waits(self):
+        self.send_later()
+        start = time.monotonic()
+        response = await self.async_client.get(reverse_lazy("async_sync_url"),
+                                               self.get_params)
+        self.assertPayloadMessageCount(response, 1)
+        self.assertLess(time.monotonic() - start, 5)
+
+    @override_settings(SMSSYNC_LONG_POLL_TIMEOUT=0.1)
+    def test_get_task_timeout(self):
+        start = time.monotonic()
+        response = self.client.get(reverse_lazy("sync_url"), self.get_params)
+        self.assertPayloadMessageCount(response, 0)
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+
+class ReceiveHandlerTests(SMSSyncAssertions, TransactionTestCase):
+
+    def setUp(self):
+        self.url = reverse_lazy("sync_url")
+        self.post_params = self.get_post_params(
+            message="join chess club")
+        self.handled = []
+
+    def register(self, **kwargs):
+        handler = smssync.register_receive_handler(self.handled.append,
+                                                   **kwargs)
+        self.addCleanup(smssync.unregister_receive_handler, handler)
+        self.addCleanup(receive_handlers.join)
+
+    def make(self, text, sent_from="+000-000-0000"):
+        return IncomingMessage(sent_from=sent_from, message=text)
+
+    def test_handler_matches(self):
+        self.assertTrue(Handler(None).matches(self.make("hi")))
+        handler = Handler(None, sent_from="+000-000-0000", prefix="JOIN ")
+        self.assertTrue(handler.matches(self.make("  Join chess")))
+        self.assertFalse(handler.matches(self.make("joinchess")))
+        self.assertFalse(handler.matches(self.make("join chess",
+                                                   "+000-000-0001")))
+        handler = Handler(None, regex=r"(?i)stop\b")
+        self.assertTrue(handler.matches(self.make("STOP now")))
+        self.assertFalse(handler.matches(self.make("please stop")))
+
+    def test_post_dispatches_to_handler(self):
+        self.register(prefix="join")
+        response = self.client.post(self.url, self.post_params)
+        self.assertPayloadSuccess(response)
+        receive_handlers.join()
+        self.assertEqual([m.id for m in self.handled],
+                         [IncomingMessage._meta.pk.to_python(
+                             self.post_params['message_id'])])
+        self.assertUnreceivedIncomingMessageCount(0)
+
+    def test_post_again_dispatches_once(self):
+        self.register(prefix="join")
+        for i in range(2):
+            response = self.client.post(self.url, self.post_params)
+            self.assertPayloadSuccess(response)
+            receive_handlers.join()
+        self.assertEqual(len(self.handled), 1)
+
+    def test_unmatched_messages_stay_queued(self):
+        self.register(prefix="stop")
+        response = self.client.post(self.url, self.post_params)
+        self.assertPayloadSuccess(response)
+        receive_handlers.join()
+        self.assertEqual(self.handled, [])
+        self.assertUnreceivedIncomingMessageCount(1)
+
+    def test_failing_handler(self):
+        dispatcher = Dispatcher()
+        message = IncomingMessage.create(**self.post_params)
+        def fail(message):
+            raise RuntimeError
+        dispatcher.register(Handler(fail))
+        dispatcher.register(Handler(self.handled.append))
+        with self.assertLogs('smssync.handlers', 'ERROR'):
+            dispatcher.handle([message])
+        # the other handlers still run
+        self.assertEqual(self.handled, [message])
+        self.assertUnreceivedIncomingMessageCount(1)
+
+    @override_settings(SMSSYNC_HANDLER_THREADS=0,
+                       SMSSYNC_HANDLER_QUEUE_SIZE=2)
+    def test_full_queue(self):
+        dispatcher = Dispatcher()
+        dispatcher.register(Handler(self.handled.append))
+        messages = [self.make("hi") for i in range(3)]
+        with self.assertLogs('smssync.handlers', 'WARNING') as logs:
+            self.assertEqual(dispatcher.dispatch(messages), 2)
+        self.assertIn(str(messages[2].id), logs.output[0])
+
+
+class KeywordRouterTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        self.routed = []
+        self.router = KeywordRouter()
+        for keyword in ("STOP", "JOIN", "JOIN VIP"):
+            self.router.add(keyword, self.route_to(keyword))
+
+    def route_to(self, keyword):
+        return lambda message, rest: self.routed.append((keyword, rest))
+
+    def make(self, text):
+        return IncomingMessage(sent_from="+000-000-0000", message=text)
+
+    def test_resolve(self):
+        for text, keyword, rest in [("stop", "STOP", ""),
+                                    ("  Join\tchess  club ", "JOIN",
+                                     "chess club"),
+                                    ("join vip lounge", "JOIN VIP", "lounge"),
+                                    ("JOIN", "JOIN", "")]:
+            route, found_rest = self.router.resolve(text)
+            self.assertEqual((route.keyword, found_rest), (keyword, rest))
+        self.assertEqual(self.router.resolve("stopped"), (None, "stopped"))
+        self.assertEqual(self.router.resolve(""), (None, ""))
+
+    def test_duplicate_keyword(self):
+        self.assertRaises(ValueError, self.router.add, " join  vip",
+                          self.route_to("again"))
+
+    def test_handle_counts_hits(self):
+        for text in ("STOP", "stop please", "join chess", "hello"):
+            self.router.handle(self.make(text))
+        self.assertEqual(self.routed, [("STOP", ""), ("STOP", "please"),
+                                       ("JOIN", "chess")])
+        self.assertEqual(self.router.hits(),
+                         {"STOP": 2, "JOIN": 1, "JOIN VIP": 0})
+        self.assertEqual(self.router.misses, 1)
+
+    def test_default_route(self):
+        self.router.default = self.route_to(None)
+        self.assertTrue(self.router.handle(self.make("hello there")))
+        self.assertEqual(self.routed, [(None, "hello there")])
+
+    def test_dispatch_marks_routed_messages_received(self):
+        dispatcher = Dispatcher()
+        dispatcher.register(self.router)
+        messages = [mommy.make(IncomingMessage, sent_from="+000-000-000",
+                               message=text) for text in ("stop", "hello")]
+        dispatcher.handle(messages)
+        self.assertEqual(list(IncomingMessage.objects.incoming()),
+                         [messages[1]])
+
 
 class APITests(SMSSyncBaseTest):
 
@@ -235,20 +1506,34 @@ class APITests(SMSSyncBaseTest):
                        sent_from="+000-000-00{}".format(str(i)))
 
     def test_send(self):
-        from smssync import smssync
         self.assertOutgoingMessageCount(0)
         om = smssync.send("Hello", "+000-000-000")
         assert isinstance (om, OutgoingMessage)
         self.assertOutgoingMessageExists(om.id)
         self.assertUnsentOutgoingMessageCount(1)
 
+    def test_send_single_query(self):
+        with self.assertNumQueries(1):
+            smssync.send("Hello", "+000-000-000")
+
+    def test_send_many(self):
+        messages = [("Hello {}".format(i), "+000-000-00{}".format(i % 3))
+                    for i in range(7)]
+        with self.assertNumQueries(3):
+            ids = smssync.send_many(iter(messages), batch_size=3)
+        self.assertEqual(len(ids), 7)
+        self.assertOutgoingMessageCount(7)
+        self.assertUnsentOutgoingMessageCount(7)
+        for id, (text, to) in zip(ids, messages):
+            om = OutgoingMessage.objects.get(id=id)
+            self.assertEqual((om.message, str(om.to)), (text, to))
+
     def test_receive(self):
         """
         Test if messages are correctly marked as reveived when received
         """
         initial = 4
         self._setup_incoming(initial)
-        from smssync import smssync
         self.assertIncomingMessageCount(initial)
         self.assertUnreceivedIncomingMessageCount(initial)
         received_count = 0
@@ -267,7 +1552,6 @@ class APITests(SMSSyncBaseTest):
         """
         initial = 4
         self._setup_incoming(initial)
-        from smssync import smssync
         self.assertIncomingMessageCount(initial)
         self.assertUnreceivedIncomingMessageCount(initial)
         received_count = 0
@@ -287,7 +1571,6 @@ class APITests(SMSSyncBaseTest):
         initial = 8
         stop = 3
         self._setup_incoming(initial)
-        from smssync import smssync
         self.assertIncomingMessageCount(initial)
         self.assertUnreceivedIncomingMessageCount(initial)
         received_count = 0
@@ -298,3 +1581,249 @@ class APITests(SMSSyncBaseTest):
         self.assertEqual(received_count, stop)
         self.assertUnreceivedIncomingMessageCount(initial-stop)
         self.assertIncomingMessageCount(initial)
+
+    def test_receive_batches(self):
+        """
+        Test batches are marked as received only once the consumer moves
+        past them, with one UPDATE per batch
+        """
+        initial = 7
+        self._setup_incoming(initial)
+        batches = smssync.receive_batches(batch_size=3)
+        first = next(batches)
+        self.assertEqual(len(first), 3)
+        self.assertUnreceivedIncomingMessageCount(initial)
+        with self.assertNumQueries(1):
+            second = next(batches)
+        self.assertEqual(len(second), 3)
+        self.assertUnreceivedIncomingMessageCount(initial-3)
+        third = next(batches)
+        self.assertEqual(len(third), 1)
+        self.assertRaises(StopIteration, next, batches)
+        self.assertUnreceivedIncomingMessageCount(0)
+        ids = [m.id for batch in (first, second, third) for m in batch]
+        self.assertEqual(len(set(ids)), initial)
+
+    def test_receive_batches_break(self):
+        """
+        Test a batch the consumer didn't get past is received again
+        """
+        self._setup_incoming(4)
+        for batch in smssync.receive_batches(batch_size=2):
+            first = batch
+            break
+        self.assertUnreceivedIncomingMessageCount(4)
+        again = next(smssync.receive_batches(batch_size=2))
+        self.assertEqual([m.id for m in again], [m.id for m in first])
+
+    def test_receive_batches_from(self):
+        self._setup_incoming(4)
+        mommy.make(IncomingMessage, sent_from="+000-000-000")
+        batches = list(smssync.receive_batches(batch_size=10,
+                                               sent_from="+000-000-000"))
+        self.assertEqual([len(b) for b in batches], [2])
+        self.assertUnreceivedIncomingMessageCount(3)
+
+
+class MemoryBackendTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        # a new backend, with empty queues, for each test
+        backend = override_settings(
+            SMSSYNC_BACKEND='smssync.backends.memory.MemoryBackend')
+        backend.enable()
+        self.addCleanup(backend.disable)
+        self.url = reverse_lazy("sync_url")
+        self.secret = settings.SMSSYNC_SECRET_KEY
+        self.post_params = self.get_post_params()
+
+    def test_get_backend(self):
+        self.assertIsInstance(get_backend(), MemoryBackend)
+        self.assertIs(get_backend(), get_backend())
+
+    def test_send(self):
+        with self.assertNumQueries(0):
+            om = smssync.send("Hello", "+000-000-000")
+            ids = smssync.send_many([("Hi", "+000-000-001")] * 2)
+        assert isinstance(om, OutgoingMessage)
+        self.assertOutgoingMessageCount(0)
+        get_params = {'task': "send",
+                      'secret': self.secret}
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, get_params)
+        self.assertEqual([m['uuid'] for m in
+                          self.json(response)['payload']['messages']],
+                         [str(id) for id in [om.id] + ids])
+        response = self.client.get(self.url, get_params)
+        self.assertPayloadMessageCount(response, 0)
+
+    def test_receive(self):
+        with self.assertNumQueries(0):
+            self.assertPayloadSuccess(self.client.post(self.url,
+                                                       self.post_params))
+            self.assertPayloadSuccess(self.client.post(self.url,
+                                                       self.post_params))
+        self.assertIncomingMessageCount(0)
+        received = list(smssync.receive())
+        self.assertEqual([str(m.id) for m in received],
+                         [self.post_params['message_id']])
+        self.assertEqual(list(smssync.receive()), [])
+
+    def test_device_queues(self):
+        shared = smssync.send("Hello", "+000-000-000")
+        mine = smssync.send("Hello", "+000-000-000", device_id="1")
+        smssync.send("Hello", "+000-000-000", device_id="2")
+        self.assertEqual(get_backend().pending_counts(["1", "2", "3"]),
+                         {"1": 1, "2": 1, "3": 0})
+        self.assertEqual([m['uuid'] for m in
+                          get_backend().claim(device_id="1")],
+                         [mine.id, shared.id])
+        self.assertEqual(get_backend().claim(), [])
+
+    def test_receive_batches(self):
+        for i in range(3):
+            params = dict(self.post_params,
+                          message_id="6b5232ad-2bb3-4d94-8dcb-3a50ffbcad{:02d}"
+                                     .format(i),
+                          **{'from': "+000-000-00{}".format(i % 2)})
+            self.client.post(self.url, params)
+        for batch in smssync.receive_batches(batch_size=2):
+            break
+        self.assertEqual(
+            [len(b) for b in smssync.receive_batches(batch_size=2)], [2, 1])
+        for i in range(2):
+            self.client.post(self.url, dict(self.post_params,
+                message_id="6b5232ad-2bb3-4d94-8dcb-3a50ffbcad{:02d}"
+                           .format(i + 10)))
+        batches = list(smssync.receive_batches(sent_from="+000-000-0000"))
+        self.assertEqual([len(b) for b in batches], [2])
+
+
+def get_test_redis():
+    """A client of the Redis server at SMSSYNC_REDIS_URL, or of a fakeredis
+    one if it can't be reached, None if neither is available"""
+    try:
+        import redis
+    except ImportError:
+        return None
+    from smssync.conf import get_setting
+    client = redis.Redis.from_url(get_setting('SMSSYNC_REDIS_URL'))
+    try:
+        client.ping()
+        return client
+    except redis.ConnectionError:
+        pass
+    try:
+        import fakeredis
+    except ImportError:
+        return None
+    return fakeredis.FakeRedis()
+
+
+test_redis = get_test_redis()
+
+
+@skipUnless(test_redis, "Redis not available")
+class RedisBackendTests(SMSSyncBaseTest):
+
+    def setUp(self):
+        prefix = 'smssync-test-{}'.format(uuid.uuid4())
+        backend = override_settings(
+            SMSSYNC_BACKEND='smssync.backends.redis.RedisBackend',
+            SMSSYNC_REDIS_PREFIX=prefix)
+        backend.enable()
+        self.addCleanup(backend.disable)
+        with mock.patch('redis.Redis.from_url', return_value=test_redis):
+            self.backend = get_backend()
+        self.addCleanup(self.flush, prefix)
+        self.params = {'from': "+000-000-0000",
+                       'message': "sample text",
+                       'sent_timestamp': "1298244863000"}
+
+    def flush(self, prefix):
+        keys = list(test_redis.scan_iter(match=prefix + ':*'))
+        if keys:
+            test_redis.delete(*keys)
+
+    def build(self, i, **kwargs):
+        return IncomingMessage.build(**dict(
+            self.params, message_id="6b5232ad-2bb3-4d94-8dcb-3a50ffbcad{:02d}"
+                                    .format(i), **kwargs))
+
+    def test_claim(self):
+        shared = self.backend.send("Hello", "+000-000-000")
+        mine = self.backend.send("Hello", "+000-000-000", device_id="1")
+        ids = self.backend.send_many([("Hi", "+000-000-001")] * 3)
+        self.assertEqual(self.backend.pending_counts(["", "1", "2"]),
+                         {"": 4, "1": 1, "2": 0})
+        self.assertEqual(self.backend.queue_depths(),
+                         {'outgoing': 5, 'incoming': 0})
+        self.assertEqual([m['uuid'] for m in
+                          self.backend.claim(2, device_id="1")],
+                         [str(mine.id), str(shared.id)])
+        self.assertEqual([m['uuid'] for m in self.backend.claim()],
+                         [str(id) for id in ids])
+        self.assertEqual(self.backend.claim(), [])
+        self.assertEqual(test_redis.llen(self.backend.sent_key), 5)
+
+    def test_claim_all_of_a_large_queue(self):
+        # more messages than unpack() takes at once
+        count = 10000
+        self.backend.send_many([("Hi", "+000-000-001")] * count)
+        self.assertEqual(len(self.backend.claim()), count)
+        self.assertEqual(test_redis.llen(self.backend.sent_key), count)
+
+    def test_store_and_receive(self):
+        messages = [self.build(i, **{'from': "+000-000-000{}".format(i % 2)})
+                    for i in range(3)]
+        self.assertEqual(self.backend.store(messages), messages)
+        # posted again, alone or within a batch
+        self.assertEqual(self.backend.store(messages[:1]), [])
+        self.assertEqual(self.backend.store([self.build(3), self.build(3)]),
+                         [self.build(3)])
+        self.assertEqual(self.backend.queue_depths()['incoming'], 4)
+        batches = list(self.backend.receive_batches(
+            batch_size=1, sent_from="+000-000-0001"))
+        self.assertEqual([[m.id for m in b] for b in batches],
+                         [[messages[1].id]])
+        self.assertEqual([m.id for m in self.backend.receive()],
+                         [messages[0].id, messages[2].id,
+                          self.build(3).id])
+        self.assertEqual(list(self.backend.receive()), [])
+
+    def test_mark_as_received(self):
+        messages = [self.build(i) for i in range(2)]
+        self.backend.store(messages)
+        self.backend.mark_as_received(messages[:1])
+        self.assertEqual([m.id for m in self.backend.receive()],
+                         [messages[1].id])
+
+    def test_archive(self):
+        sent = self.backend.send("Hello", "+000-000-000")
+        self.backend.send("Later", "+000-000-000")
+        self.backend.claim(1)
+        self.backend.store([self.build(0), self.build(1)])
+        list(self.backend.receive_batches(batch_size=1))
+        self.assertEqual(self.backend.archive(batch_size=1), 3)
+        archived = OutgoingMessage.objects.get()
+        self.assertEqual(archived.id, sent.id)
+        self.assertEqual(archived.status, OutgoingMessage.SENT)
+        self.assertIsNotNone(archived.sent_timestamp)
+        self.assertEqual(OutgoingMessage.objects.outgoing().count(), 0)
+        self.assertEqual(IncomingMessage.objects.filter(
+            received=True).count(), 2)
+        self.assertEqual(self.backend.archive(), 0)
+        # the message not claimed yet stays queued in Redis
+        self.assertEqual(self.backend.pending_counts([""]), {"": 1})
+
+    def test_archive_failure_puts_messages_back(self):
+        self.backend.send_many([("Hi", "+000-000-001")] * 3)
+        self.backend.claim()
+        done = test_redis.lrange(self.backend.sent_key, 0, -1)
+        with mock.patch.object(OutgoingMessage.objects, 'bulk_create',
+                               side_effect=DatabaseError):
+            self.assertRaises(DatabaseError, self.backend.archive, 2)
+        self.assertEqual(test_redis.lrange(self.backend.sent_key, 0, -1),
+                         done)
+        self.assertEqual(self.backend.archive(2), 3)
+        self.assertOutgoingMessageCount(3)
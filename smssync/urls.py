@@ -18,10 +18,10 @@
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.conf.urls import url
+from django.urls import re_path
 
 from smssync import views
 
 urlpatterns = [
-    url(r'^', views.SyncView.as_view(), name='sync_url'),
+    re_path(r'^', views.SyncView.as_view(), name='sync_url'),
 ]
@@ -17,19 +17,35 @@
 # You should have received a copy of the GNU General Public License
 # along with django-smssync.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.http import JsonResponse
+import json
+import time
+import uuid
+
+from django.http import (Http404, HttpResponse, JsonResponse,
+                         StreamingHttpResponse)
+from django.core.serializers.json import DjangoJSONEncoder
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from django.utils.decorators import method_decorator
 from django.core.exceptions import ValidationError
-from django.db import transaction
-from django.conf import settings
 
 from smssync.models import IncomingMessage, OutgoingMessage
-from smssync.decorators import secret_required
+from smssync.backends import get_backend
+from smssync.decorators import (secret_required, async_secret_required,
+                                get_request_device_id)
+from smssync.devices import get_device_secrets
+from smssync.db import database_sync_to_async
+from smssync.handlers import dispatch_received
+from smssync.logs import MessageLogger
+from smssync.metrics import (count_messages, get_metrics, increment, timed,
+                             PrometheusMetrics)
+from smssync.conf import get_setting, get_send_batch_size
+from smssync.ratelimit import RateLimiter
+from smssync import notify
 
 import logging
 logger = logging.getLogger(__name__)
+message_logger = MessageLogger(logger)
 
 
 def get_msg_kwargs(request_dict):
@@ -43,69 +59,304 @@ def get_msg_kwargs(request_dict):
     return {k:v for k,v in request_dict.items() if k in KEYWORDS}
 
 
+class StreamingJsonResponse(StreamingHttpResponse):
+    """JSON response encoded incrementally while it is sent to the client
+
+    The encoder output is regrouped in chunks of about ``chunk_size``
+    characters so the server doesn't write one tiny string per token.
+    """
+    def __init__(self, data, encoder=DjangoJSONEncoder, chunk_size=8192,
+                 **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        content = self._chunked(encoder().iterencode(data), chunk_size)
+        super(StreamingJsonResponse, self).__init__(content, **kwargs)
+
+    @staticmethod
+    def _chunked(iterable, chunk_size):
+        buf = []
+        size = 0
+        for s in iterable:
+            buf.append(s)
+            size += len(s)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+
 @method_decorator([csrf_exempt, secret_required], name='dispatch')
 class SyncView(View):
 
-    @transaction.atomic
     def post(self, request):
-        task = request.POST.get('task', '')
-        if task == 'result':
-            response = get_sms_delivery_report(
-                get_msg_kwargs(request.POST))
-        elif task == 'sent':
-            response = get_sent_message_uuids(
-                get_msg_kwargs(request.POST))
-        else:
-            response = get_message(
-                get_msg_kwargs(request.POST))
+        return JsonResponse(post_task(request))
+
+    def get(self, request):
+        deadline = time.monotonic() + get_setting('SMSSYNC_LONG_POLL_TIMEOUT')
+        while True:
+            since = notify.outgoing.version
+            response = get_task(request)
+            timeout = deadline - time.monotonic()
+            if not should_wait(request, response, timeout):
+                break
+            if not notify.outgoing.wait(timeout, since):
+                break
+        return StreamingJsonResponse(response)
 
+
+@method_decorator([csrf_exempt, async_secret_required], name='dispatch')
+class AsyncSyncView(View):
+    """SyncView for projects served over ASGI
+
+    Requests don't hold a worker thread: the database work of each task
+    runs in smssync's own thread pool (see smssync.db) while the event loop
+    keeps serving other devices, including long polling ones.
+    """
+
+    async def post(self, request):
+        response = await database_sync_to_async(post_task)(request)
         return JsonResponse(response)
 
-    @transaction.atomic
-    def get(self, request):
-        task = request.GET.get('task', '')
-        if task == 'send':
-            response = send_task(request.GET)
-        elif task == 'result':
-            response = send_messages_uuids_for_sms_delivery_report(request.GET)
+    async def get(self, request):
+        deadline = time.monotonic() + get_setting('SMSSYNC_LONG_POLL_TIMEOUT')
+        while True:
+            since = notify.outgoing.version
+            response = await database_sync_to_async(get_task)(request)
+            timeout = deadline - time.monotonic()
+            if not should_wait(request, response, timeout):
+                break
+            if not await notify.outgoing.async_wait(timeout, since):
+                break
+        # ASGI servers would consume a streamed body in a worker thread
         return JsonResponse(response)
 
 
+def should_wait(request, response, timeout):
+    """Whether a send task found nothing to send and may wait for new
+    messages (see SMSSYNC_LONG_POLL_TIMEOUT)"""
+    return (timeout > 0 and
+            request.GET.get('task') == 'send' and
+            not response['payload']['messages'])
+
+
+def post_task(request):
+    task = request.POST.get('task', request.GET.get('task', ''))
+    device_id = get_request_device_id(request)
+    if task == 'batch':
+        response = get_messages(request.body, device_id)
+    elif task == 'result':
+        response = get_sms_delivery_report(request.body)
+    elif task == 'sent':
+        response = get_sent_message_uuids(request.body)
+    else:
+        response = get_message(
+            dict(get_msg_kwargs(request.POST), device_id=device_id or ""))
+    return response
+
+
+def get_task(request):
+    task = request.GET.get('task', '')
+    if task == 'send':
+        response = send_task(dict(request.GET.items(),
+                                  device_id=get_request_device_id(request)))
+    elif task == 'result':
+        response = send_messages_uuids_for_sms_delivery_report(request.GET)
+    else:
+        payload={}
+        payload['success'] = False
+        payload['error'] = "Unknown task: {}".format(task)
+        response = {"payload":payload}
+    return response
+
+
+@timed('get_message')
 def get_message(params):
-    logger.info("Receiving message: {}".format(repr(params)))
+    message_logger.log("Receiving message: %r", [params])
     payload={}
     payload['success'] = False
     payload['error'] = None
 
     try:
-        IncomingMessage.create(**params)
+        messages = [IncomingMessage.build(**params)]
+        dispatch_received(get_backend().store(messages))
     except (KeyError, ValueError, ValidationError) as e:
-        payload['error'] = str(e.args[0])
+        payload['error'] = get_error_message(e)
+        increment('messages_rejected', 1, params.get('device_id'))
     except Exception:
         raise
     else:
         payload['success'] = True
+        count_messages('messages_received', messages)
 
     return {"payload":payload}
 
 
+@timed('get_messages')
+def get_messages(body, device_id=None):
+    """Receive a JSON array of messages from ``device_id``, stored all at
+    once
+
+    Each element holds the same fields SMSSync posts for a single message,
+    but the device is always the one the request was authenticated for.
+    Messages that were already received are ignored, so the device can
+    safely post a batch again. The payload reports the outcome of each
+    message, in the order they were sent.
+    """
+    payload={}
+    payload['success'] = False
+    payload['error'] = None
+
+    items = load_json(body)
+    if not isinstance(items, list):
+        payload['error'] = "The request body must be a JSON array of messages"
+        return {"payload":payload}
+
+    messages = []
+    results = []
+    for item in items:
+        result = {'message_id': None,
+                  'success': False,
+                  'error': None}
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("Message must be a JSON object")
+            params = get_msg_kwargs({k: str(v) for k, v in item.items()
+                                     if v is not None})
+            params['device_id'] = device_id or ""
+            result['message_id'] = params.get('message_id')
+            messages.append(IncomingMessage.build(**params))
+        except (KeyError, ValueError, ValidationError) as e:
+            result['error'] = get_error_message(e)
+        else:
+            result['success'] = True
+        results.append(result)
+
+    dispatch_received(get_backend().store(messages))
+    count_messages('messages_received', messages)
+    increment('messages_rejected', len(items) - len(messages))
+    logger.info("Received %d of %d messages", len(messages), len(items))
+
+    payload['success'] = True
+    payload['messages'] = results
+    return {"payload":payload}
+
+
+def load_json(body):
+    """Decode a JSON request body, None if it isn't valid JSON"""
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def get_uuids(values):
+    """The valid UUIDs among ``values``"""
+    uuids = []
+    for value in values:
+        try:
+            uuids.append(uuid.UUID(str(value)))
+        except ValueError:
+            pass
+    return uuids
+
+
+def get_sent_message_uuids(body):
+    """Acknowledge the messages SMSSync queued for sending
+
+    SMSSync posts {"queued_messages": [uuid, ...]} and expects the uuids of
+    the messages the server knows about in return.
+    """
+    data = load_json(body)
+    uuids = []
+    if isinstance(data, dict) and isinstance(data.get('queued_messages'),
+                                             list):
+        uuids = OutgoingMessage.objects.acknowledge(
+            get_uuids(data['queued_messages']))
+    return {"message_uuids": [str(u) for u in uuids]}
+
+
+def get_sms_delivery_report(body):
+    """Record the sent and delivered results posted by SMSSync as
+    {"message_result": [{"uuid": ..., "sent_result_code": ..., ...}, ...]}
+    """
+    payload={}
+    payload['success'] = False
+    payload['error'] = None
+
+    data = load_json(body)
+    if (not isinstance(data, dict) or
+            not isinstance(data.get('message_result'), list)):
+        payload['error'] = "The request body must hold a message_result list"
+        return {"payload":payload}
+
+    results = []
+    for result in data['message_result']:
+        if isinstance(result, dict) and get_uuids([result.get('uuid')]):
+            results.append(result)
+    try:
+        OutgoingMessage.objects.report_results(results)
+    except (TypeError, ValueError) as e:
+        payload['error'] = get_error_message(e)
+    else:
+        payload['success'] = True
+    return {"payload":payload}
+
+
+def send_messages_uuids_for_sms_delivery_report(params):
+    """Ask SMSSync for the results of up to SMSSYNC_RESULT_BATCH_SIZE sent
+    messages, the ones last asked about the longest ago first"""
+    limit = get_setting('SMSSYNC_RESULT_BATCH_SIZE')
+    uuids = OutgoingMessage.objects.request_reports(limit)
+    return {"message_uuids": [str(u) for u in uuids]}
+
+
+def get_error_message(e):
+    if isinstance(e, ValidationError):
+        return e.messages[0]
+    return str(e.args[0])
+
+
+@timed('send_task')
 def send_task(params):
 
     payload={}
     payload['task'] = 'send'
-    payload['secret'] = settings.SMSSYNC_SECRET_KEY
-    payload['messages'] = get_outgoing_messages()
+    device_id = params.get('device_id')
+    payload['secret'] = get_device_secrets().get(device_id)
+    limit = get_send_batch_size(device_id)
+    rate_limiter = RateLimiter()
+    allowance = rate_limiter.allowance(device_id)
+    if allowance is not None:
+        limit = min(limit, allowance)
+    payload['messages'] = get_outgoing_messages(limit, device_id)
+    rate_limiter.consume(device_id, len(payload['messages']))
+    increment('polls', 1, device_id)
+    increment('messages_sent', len(payload['messages']), device_id)
     payload['error'] = None
 
     return {"payload":payload}
 
 
-def get_outgoing_messages():
-
-    messages = []
+@timed('get_outgoing_messages')
+def get_outgoing_messages(limit=None, device_id=None):
+    """Claim at most ``limit`` pending messages for ``device_id``"""
 
-    for m in OutgoingMessage.objects.outgoing():
-        m.mark_as_sent()
-        messages.append(m.task_dict)
-        logger.info("Sending message: {}".format(repr(m.task_dict)))
+    if limit == 0:
+        return []
+    messages = get_backend().claim(limit, device_id)
+    message_logger.log("Sending message: %r", messages)
     return messages
+
+
+def metrics(request):
+    """Measurements of PrometheusMetrics, for Prometheus to scrape
+
+    Not part of smssync.urls: projects using it add it to their own URLs,
+    behind whatever access control their metrics need.
+    """
+    registry = get_metrics()
+    if not isinstance(registry, PrometheusMetrics):
+        raise Http404("Prometheus metrics are not enabled")
+    return HttpResponse(registry.render(),
+                        content_type=PrometheusMetrics.CONTENT_TYPE)
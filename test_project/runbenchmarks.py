@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the hot paths of django-smssync.
+
+Each run uses a fresh test database, SQLite by default or a local PostgreSQL
+one with --postgres (see SMSSYNC_POSTGRES in the test_project settings).
+
+history     cost of a device poll as the message tables grow. Each round
+            adds already sent/received history and keeps the number of
+            pending messages constant; with the queue indexes in place the
+            timings should stay flat.
+inbound     messages posted per second through SyncView, one per request
+            as SMSSync does, and in JSON batches of 100.
+send        latency of a task=send poll against the number of queued
+            messages.
+receive     messages drained per second by smssync.receive() and
+            smssync.receive_batches().
+send_many   messages queued per second by smssync.send_many().
+logging     cost per message of the message logs of the sync views,
+            formatted eagerly as they used to be and through
+            smssync.logs.MessageLogger, with INFO logging off and on.
+
+Results are printed as tables, or as JSON with --json to compare runs.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import sys
+import timeit
+import uuid
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner
+
+HISTORY_SIZES = [1000, 10000, 100000]
+QUEUE_DEPTHS = [1, 100, 1000, 10000, 100000]
+PENDING = 100
+REPEAT = 20
+MESSAGES = 1000
+
+
+def bench(func):
+    return min(timeit.repeat(func, number=1, repeat=REPEAT))
+
+
+def throughput(count, func):
+    """Items per second processed by a single call to func"""
+    return count / timeit.timeit(func, number=1)
+
+
+def rolled_back(func):
+    """Wrap func in a transaction that is rolled back, so that repeated
+    runs see the same queues"""
+    from django.db import transaction
+
+    def run():
+        with transaction.atomic():
+            func()
+            transaction.set_rollback(True)
+    return run
+
+
+def clear():
+    from smssync.models import IncomingMessage, OutgoingMessage
+    OutgoingMessage.objects.all().delete()
+    IncomingMessage.objects.all().delete()
+
+
+def add_outgoing(count, **kwargs):
+    from smssync.models import OutgoingMessage
+    OutgoingMessage.objects.bulk_create(
+        (OutgoingMessage(to="+000-000-000", message="pending", **kwargs)
+         for i in range(count)), batch_size=1000)
+
+
+def add_incoming(count, **kwargs):
+    from smssync.models import IncomingMessage
+    IncomingMessage.objects.bulk_create(
+        (IncomingMessage(sent_from="+000-000-000", message="pending",
+                         sent_timestamp="2016-03-11 00:00", **kwargs)
+         for i in range(count)), batch_size=1000)
+
+
+def poll_cost(history_sizes):
+    from smssync.models import IncomingMessage, OutgoingMessage
+
+    def poll():
+        list(OutgoingMessage.objects.claim(PENDING).task_values())
+
+    def incoming():
+        list(IncomingMessage.objects.incoming()[:PENDING])
+
+    clear()
+    add_outgoing(PENDING)
+    add_incoming(PENDING)
+
+    rows = 0
+    for size in history_sizes:
+        add_outgoing(size - rows, status=OutgoingMessage.SENT)
+        add_incoming(size - rows, received=True)
+        rows = size
+        yield {'history': size,
+               'send_ms': bench(rolled_back(poll)) * 1000,
+               'receive_ms': bench(incoming) * 1000}
+
+
+def inbound(count):
+    from django.test import Client
+    from django.urls import reverse
+
+    client = Client()
+    url = reverse("sync_url")
+    secret = settings.SMSSYNC_SECRET_KEY
+
+    def message():
+        return {'from': "+000-000-000",
+                'message': "sample text",
+                'device_id': "1",
+                'sent_timestamp': "1298244863000",
+                'message_id': str(uuid.uuid4())}
+
+    def single():
+        for i in range(count):
+            client.post(url, dict(message(), secret=secret))
+
+    def batches():
+        batch_url = "{}?task=batch&secret={}".format(url, secret)
+        for i in range(0, count, PENDING):
+            body = json.dumps([message()
+                               for j in range(min(PENDING, count - i))])
+            client.post(batch_url, body, content_type="application/json")
+
+    clear()
+    yield {'mode': "single", 'messages_per_s': throughput(count, single)}
+    yield {'mode': "batch", 'messages_per_s': throughput(count, batches)}
+
+
+def send_latency(depths):
+    from django.test import Client
+    from django.urls import reverse
+
+    client = Client()
+    url = reverse("sync_url")
+    params = {'task': "send", 'secret': settings.SMSSYNC_SECRET_KEY}
+
+    def poll():
+        client.get(url, params)
+
+    clear()
+    queued = 0
+    for depth in depths:
+        add_outgoing(depth - queued)
+        queued = depth
+        yield {'queued': depth, 'poll_ms': bench(rolled_back(poll)) * 1000}
+
+
+def receive_drain(count):
+    from smssync import smssync
+
+    def receive():
+        for message in smssync.receive():
+            pass
+
+    def receive_batches():
+        for batch in smssync.receive_batches(batch_size=PENDING):
+            pass
+
+    clear()
+    add_incoming(count)
+    yield {'mode': "receive", 'messages_per_s': throughput(count, receive)}
+    add_incoming(count)
+    yield {'mode': "receive_batches",
+           'messages_per_s': throughput(count, receive_batches)}
+
+
+def send_many(count):
+    from smssync import smssync
+
+    messages = [("Hello", "+1 650 253 {:04d}".format(i % PENDING))
+                for i in range(count)]
+
+    def send():
+        smssync.send_many(messages)
+
+    clear()
+    yield {'messages': count, 'messages_per_s': throughput(count, send)}
+
+
+def logging_cost(count):
+    from smssync.logs import MessageLogger
+    from smssync.models import OutgoingMessage
+
+    logger = logging.getLogger('smssync.benchmark')
+    logger.propagate = False
+    handler = logging.StreamHandler(io.StringIO())
+    logger.addHandler(handler)
+    message_logger = MessageLogger(logger)
+    tasks = [OutgoingMessage.make_task_dict(uuid.uuid4(), "+16502530000",
+                                            "Hello")
+             for i in range(count)]
+
+    def eager():
+        for task in tasks:
+            logger.info("Sending message: {}".format(repr(task)))
+
+    def lazy():
+        message_logger.log("Sending message: %r", tasks)
+
+    for level in (logging.WARNING, logging.INFO):
+        logger.setLevel(level)
+        yield {'level': logging.getLevelName(level),
+               'eager_us': bench(eager) * 1e6 / count,
+               'lazy_us': bench(lazy) * 1e6 / count}
+    logger.removeHandler(handler)
+
+
+def get_benchmarks(options):
+    return {
+        'history': lambda: poll_cost(options.history_sizes),
+        'inbound': lambda: inbound(options.messages),
+        'send': lambda: send_latency(options.depths),
+        'receive': lambda: receive_drain(options.messages),
+        'send_many': lambda: send_many(options.messages),
+        'logging': lambda: logging_cost(options.messages),
+    }
+
+
+def print_table(name, rows):
+    columns = list(rows[0])
+    print(name)
+    print(" ".join("{:>16}".format(column) for column in columns))
+    for row in rows:
+        print(" ".join("{:>16.3f}".format(row[column])
+                       if isinstance(row[column], float)
+                       else "{:>16}".format(row[column])
+                       for column in columns))
+    print()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the hot paths of django-smssync.")
+    parser.add_argument('benchmarks', nargs='*',
+                        help="benchmarks to run, all of them by default")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    parser.add_argument('--postgres', action='store_true',
+                        help="use the local PostgreSQL database named by "
+                             "SMSSYNC_POSTGRES (default: smssync)")
+    parser.add_argument('--quick', action='store_true',
+                        help="stop the table sizes at 10000 rows")
+    parser.add_argument('--messages', type=int, default=MESSAGES,
+                        help="messages per throughput benchmark "
+                             "(default: {})".format(MESSAGES))
+    options = parser.parse_args(argv)
+    limit = 10000 if options.quick else sys.maxsize
+    options.history_sizes = [size for size in HISTORY_SIZES if size <= limit]
+    options.depths = [depth for depth in QUEUE_DEPTHS if depth <= limit]
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    if options.postgres:
+        os.environ.setdefault('SMSSYNC_POSTGRES', 'smssync')
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'test_project.settings'
+    django.setup()
+
+    from django.db import connection
+
+    benchmarks = get_benchmarks(options)
+    names = options.benchmarks or list(benchmarks)
+    unknown = sorted(set(names) - set(benchmarks))
+    if unknown:
+        sys.exit("Unknown benchmarks: {}".format(", ".join(unknown)))
+
+    test_runner = get_runner(settings)(verbosity=0)
+    old_config = test_runner.setup_databases()
+    results = {}
+    try:
+        for name in names:
+            results[name] = list(benchmarks[name]())
+            if not options.json:
+                print_table(name, results[name])
+    finally:
+        test_runner.teardown_databases(old_config)
+
+    if options.json:
+        json.dump({'database': connection.vendor,
+                   'django': django.get_version(),
+                   'results': results}, sys.stdout, indent=2)
+        print()
+    sys.exit(0)
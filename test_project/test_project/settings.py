@@ -12,12 +12,30 @@ DEBUG = True
 
 ROOT_URLCONF = 'test_project.urls'
 
-TEMPLATES = [{}]
+TEMPLATES = [{
+    'BACKEND': 'django.template.backends.django.DjangoTemplates',
+    'APP_DIRS': True,
+    'OPTIONS': {
+        'context_processors': [
+            'django.contrib.auth.context_processors.auth',
+            'django.contrib.messages.context_processors.messages',
+            'django.template.context_processors.request',
+        ],
+    },
+}]
+
+MIDDLEWARE = [
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+]
 
 INSTALLED_APPS = [
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
+    'django.contrib.messages',
+    'django.contrib.sessions',
     'smssync',
 ]
 
@@ -28,4 +46,12 @@ DATABASES = {
     }
 }
 
+# runbenchmarks.py --postgres: a local PostgreSQL database, configured by
+# the usual PG* environment variables
+if os.environ.get('SMSSYNC_POSTGRES'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['SMSSYNC_POSTGRES'],
+    }
+
 SMSSYNC_SECRET_KEY = '123456'
@@ -14,12 +14,15 @@ Including another URLconf
     2. Import the include() function: from django.conf.urls import url, include
     3. Add a URL to urlpatterns:  url(r'^blog/', include(blog_urls))
 """
-from django.conf.urls import url, include
+from django.urls import include, re_path
 from django.contrib import admin
 
 import smssync
+from smssync.views import AsyncSyncView
 
 urlpatterns = [
-    url(r'^admin/', admin.site.urls),
-    url(r'^smssync/', include('smssync.urls'), name='smssync'),
+    re_path(r'^admin/', admin.site.urls),
+    re_path(r'^smssync-async/', AsyncSyncView.as_view(),
+            name='async_sync_url'),
+    re_path(r'^smssync/', include('smssync.urls'), name='smssync'),
 ]